@@ -9,6 +9,11 @@ def insert_po(final_json, sender_email=None):
 
     d = final_json["extracted_data"]
 
+    # Failed cross-checks or values not found in the document: park the PO
+    # for a human instead of letting the agent allocate stock on it
+    needs_review = final_json.get("validation", {}).get("needs_review", False)
+    status = "NEEDS_REVIEW" if needs_review else "NEW"
+
     buyer = d.get("buyer", {})
     seller = d.get("seller", {})
 
@@ -27,9 +32,9 @@ def insert_po(final_json, sender_email=None):
         INSERT INTO purchase_orders (
             po_number, po_date, buyer, supplier,
             buyer_gst, supplier_gst, currency,
-            total_amount, raw_json, sender_email
+            total_amount, raw_json, sender_email, status
         )
-        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+        VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
         RETURNING po_id
     """, (
         d.get("po_number"),
@@ -41,7 +46,8 @@ def insert_po(final_json, sender_email=None):
         d.get("currency"),
         d.get("total_amount"),
         json.dumps(final_json),    # FULL JSON stored safely
-        sender_email               # FROM EMAIL (Ingestion)
+        sender_email,              # FROM EMAIL (Ingestion)
+        status
     ))
 
     po_id = cur.fetchone()[0]
@@ -68,6 +74,10 @@ def insert_po(final_json, sender_email=None):
     conn.close()
 
     # -------- TRIGGER AGENT --------
+    if needs_review:
+        print(f"🚩 PO {po_id} saved as NEEDS_REVIEW; agent not triggered")
+        return
+
     try:
         from core.optimized_agent import process_po
         process_po(po_id)
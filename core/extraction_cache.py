@@ -0,0 +1,93 @@
+import os
+import json
+import hashlib
+
+
+# ================= CONFIG ================= #
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CACHE_DIR = os.getenv("EXTRACTION_CACHE_DIR", os.path.join(BASE_DIR, "cache", "extraction"))
+CACHE_MAX_BYTES = int(os.getenv("EXTRACTION_CACHE_MAX_MB", "200")) * 1024 * 1024
+
+# ========================================= #
+
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# One JSON file per document, named by the SHA-256 of the file bytes.
+# The file mtime doubles as the LRU timestamp: reads touch it, eviction
+# removes the oldest entries until the directory fits CACHE_MAX_BYTES.
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _entry_path(digest):
+    return os.path.join(CACHE_DIR, f"{digest}.json")
+
+
+def get(digest):
+    path = _entry_path(digest)
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        os.utime(path)      # mark as recently used
+    except OSError:
+        pass
+    return entry
+
+
+def put(digest, **fields):
+    """
+    Merge fields into the entry for digest, write it atomically and evict
+    old entries if the cache grew past its size bound.
+    """
+    entry = get(digest) or {"sha256": digest}
+    entry.update(fields)
+
+    path = _entry_path(digest)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(entry, f)
+    os.replace(tmp, path)
+
+    evict()
+    return entry
+
+
+def evict(max_bytes=CACHE_MAX_BYTES):
+    entries = []
+    total = 0
+    with os.scandir(CACHE_DIR) as it:
+        for e in it:
+            if not e.name.endswith(".json"):
+                continue
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+            total += st.st_size
+
+    if total <= max_bytes:
+        return 0
+
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            removed += 1
+        except OSError:
+            pass
+    return removed
@@ -0,0 +1,144 @@
+import os
+import re
+
+from core.po_schema import to_number
+
+
+# ================= CONFIG ================= #
+
+# OCR line score below which a value read from it is re-extracted
+OCR_MIN_SCORE = float(os.getenv("OCR_MIN_SCORE", "0.80"))
+AMOUNT_TOLERANCE = 0.01       # 1% for qty x price and total cross-checks
+# PO totals usually include GST on top of the line totals
+TAX_RATES = (0.0, 0.05, 0.12, 0.18, 0.28)
+
+ITEM_NUMBERS = ("quantity", "unit_price", "line_total")
+
+# ========================================= #
+
+# Every extracted value gets a confidence: the OCR score of the best line
+# that contains it (1.0 on digital pages), or 0.0 when the value appears
+# nowhere in the document, i.e. the model made it up. Together with the
+# arithmetic cross-checks this marks the fields worth a second look.
+
+_NUMBER_TOKEN_RE = re.compile(r"\d[\d,]*(?:\.\d+)?")
+
+
+def _norm(s):
+    return " ".join(str(s or "").lower().split())
+
+
+def evidence(pages):
+    """[(line_text, score)] for the whole document."""
+    lines = []
+    for p in pages:
+        if p.get("lines"):
+            lines.extend((text, score) for _, text, score in p["lines"])
+        else:
+            lines.extend((line, 1.0) for line in (p.get("text") or "").splitlines())
+    return lines
+
+
+def _number_index(lines):
+    """Best score per number value seen in the document."""
+    index = {}
+    for text, score in lines:
+        for tok in _NUMBER_TOKEN_RE.findall(text):
+            n = to_number(tok)
+            if n is not None and score > index.get(n, -1):
+                index[n] = score
+    return index
+
+
+def _text_confidence(value, lines):
+    v = _norm(value).replace(" ", "")
+    best = 0.0
+    for text, score in lines:
+        if v in _norm(text).replace(" ", ""):
+            best = max(best, score)
+    return best
+
+
+def confidence_map(data, pages):
+    """{field path: confidence} for the identifiers and amounts."""
+    lines = evidence(pages)
+    numbers = _number_index(lines)
+    conf = {}
+
+    if data.get("po_number"):
+        conf["po_number"] = round(_text_confidence(data["po_number"], lines), 3)
+    for party in ("buyer", "seller"):
+        gst = (data.get(party) or {}).get("gst_number")
+        if gst:
+            conf[f"{party}.gst_number"] = round(_text_confidence(gst, lines), 3)
+
+    total = to_number(data.get("total_amount"))
+    if total is not None:
+        conf["total_amount"] = round(numbers.get(total, 0.0), 3)
+
+    for i, item in enumerate(data.get("line_items") or []):
+        for field in ITEM_NUMBERS:
+            n = to_number(item.get(field))
+            if n is not None:
+                conf[f"line_items[{i}].{field}"] = round(numbers.get(n, 0.0), 3)
+    return conf
+
+
+def _close(a, b):
+    return abs(a - b) <= max(AMOUNT_TOLERANCE * abs(b), 0.01)
+
+
+def cross_checks(data):
+    """Arithmetic consistency. Returns {check: bool}."""
+    checks = {}
+    items = data.get("line_items") or []
+    for i, item in enumerate(items):
+        q, p, t = (to_number(item.get(f)) for f in ITEM_NUMBERS)
+        if None not in (q, p, t):
+            checks[f"line_items[{i}].qty_x_price"] = _close(q * p, t)
+
+    total = to_number(data.get("total_amount"))
+    line_sum = sum(to_number(it.get("line_total")) or 0 for it in items)
+    if total and line_sum:
+        checks["total_matches_items"] = any(_close(line_sum * (1 + r), total) for r in TAX_RATES)
+    return checks
+
+
+def validate(data, pages):
+    """
+    Score and cross-check an extraction. Returns a report:
+        confidence   {field: score}
+        checks       {check: bool}
+        suspect      field paths worth re-extracting
+        needs_review True if a check fails or a value isn't in the document
+    """
+    conf = confidence_map(data, pages)
+    checks = cross_checks(data)
+
+    suspect = {f for f, c in conf.items() if c < OCR_MIN_SCORE}
+    for name, ok in checks.items():
+        if ok:
+            continue
+        if name == "total_matches_items":
+            suspect.add("total_amount")
+        else:
+            row = name.split(".")[0]
+            suspect.update(f"{row}.{f}" for f in ITEM_NUMBERS)
+
+    unsupported = [f for f, c in conf.items() if c == 0.0]
+    return {
+        "confidence": conf,
+        "checks": checks,
+        "suspect": sorted(suspect),
+        "needs_review": not all(checks.values()) or bool(unsupported)
+    }
+
+
+def suspect_rows(report):
+    """Line item indexes with at least one suspect field."""
+    rows = set()
+    for field in report["suspect"]:
+        m = re.match(r"line_items\[(\d+)\]", field)
+        if m:
+            rows.add(int(m.group(1)))
+    return sorted(rows)
@@ -0,0 +1,123 @@
+import os
+
+import cv2
+import numpy as np
+
+
+# ================= CONFIG ================= #
+
+# Longest side of a page image sent to OCR. 150 DPI A4 (1240x1754) passes
+# untouched; 12 MP phone photos are scaled down before detection.
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "2200"))
+OCR_BINARIZE = os.getenv("OCR_BINARIZE", "1") == "1"
+
+BLANK_INK_RATIO = 0.002   # share of dark pixels below which a page is blank
+MAX_DESKEW_DEG = 10       # larger angles are layout, not scanner skew
+MIN_DESKEW_DEG = 0.3      # below this rotating costs more than it helps
+THUMB_SIDE = 800          # analysis (blank/skew) runs on a thumbnail
+
+# ========================================= #
+
+
+def cap_resolution(gray, max_side=OCR_MAX_SIDE):
+    h, w = gray.shape[:2]
+    longest = max(h, w)
+    if longest <= max_side:
+        return gray, 1.0
+    scale = max_side / longest
+    resized = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    return resized, scale
+
+
+def _thumbnail(gray):
+    h, w = gray.shape[:2]
+    scale = THUMB_SIDE / max(h, w)
+    if scale >= 1:
+        return gray
+    return cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+def ink_mask(gray):
+    """Dark-on-light text pixels as a 0/255 mask (Otsu on a light blur)."""
+    blur = cv2.GaussianBlur(gray, (3, 3), 0)
+    _, mask = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    return mask
+
+
+def is_blank(thumb):
+    # Otsu always finds *some* split, so also require real contrast
+    if thumb.std() < 8:
+        return True
+    mask = ink_mask(thumb)
+    return cv2.countNonZero(mask) / mask.size < BLANK_INK_RATIO
+
+
+def skew_angle(thumb):
+    """
+    Dominant text angle in degrees from the min-area rectangle around all
+    ink pixels. Returns 0 when the estimate is unreliable.
+    """
+    mask = ink_mask(thumb)
+    # Join characters into line blobs so the rectangle follows text lines
+    mask = cv2.dilate(mask, np.ones((3, 15), np.uint8))
+    pts = cv2.findNonZero(mask)
+    if pts is None or len(pts) < 100:
+        return 0.0
+
+    angle = cv2.minAreaRect(pts)[-1]
+    # Normalize across OpenCV versions ([-90, 0) before 4.5, (0, 90] after)
+    if angle > 45:
+        angle -= 90
+    elif angle < -45:
+        angle += 90
+
+    if abs(angle) > MAX_DESKEW_DEG:
+        return 0.0
+    return angle
+
+
+def rotate(gray, angle):
+    h, w = gray.shape[:2]
+    m = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    return cv2.warpAffine(
+        gray, m, (w, h),
+        flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=255
+    )
+
+
+def binarize(gray):
+    # Adaptive threshold handles uneven lighting in phone photos and scanner
+    # shadows; the block size is tuned for ~150 DPI body text.
+    return cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15
+    )
+
+
+def preprocess_page(gray):
+    """
+    Resolution cap -> blank check -> deskew -> adaptive binarization.
+
+    Returns (image, info). image is None for a blank page, which should be
+    skipped entirely. info records what was done, for the page report.
+    """
+    info = {}
+
+    gray, scale = cap_resolution(gray)
+    if scale < 1:
+        info["scale"] = round(scale, 3)
+
+    thumb = _thumbnail(gray)
+    if is_blank(thumb):
+        info["blank"] = True
+        return None, info
+
+    angle = skew_angle(thumb)
+    del thumb
+    if abs(angle) >= MIN_DESKEW_DEG:
+        gray = rotate(gray, angle)
+        info["deskew"] = round(angle, 2)
+
+    if OCR_BINARIZE:
+        gray = binarize(gray)
+
+    return gray, info
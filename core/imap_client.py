@@ -0,0 +1,413 @@
+import os
+import time
+import base64
+import quopri
+import select
+import ssl
+import imaplib
+from email.utils import collapse_rfc2231_value, decode_rfc2231
+
+from dotenv import load_dotenv
+
+# Load local environment variables
+load_dotenv()
+
+
+# ================= CONFIG ================= #
+
+IMAP_SERVER = os.getenv("IMAP_SERVER", "imap.gmail.com")
+EMAIL_USER = os.getenv("EMAIL_USER")
+EMAIL_PASS = os.getenv("EMAIL_PASS")
+
+# Re-issue IDLE before the server drops it (Gmail: ~29 min, RFC 2177: 30)
+IMAP_IDLE_TIMEOUT = int(os.getenv("IMAP_IDLE_TIMEOUT", "1500"))
+# Servers without IDLE: NOOP this often to pick up new mail
+IMAP_NOOP_INTERVAL = int(os.getenv("IMAP_NOOP_INTERVAL", "5"))
+# Attachment parts are downloaded in IMAP partial fetches of this size
+IMAP_PART_CHUNK = int(os.getenv("IMAP_PART_CHUNK", str(1024 * 1024)))
+RECONNECT_MIN_DELAY = 2       # seconds, doubled per failed attempt
+RECONNECT_MAX_DELAY = 300
+
+# ========================================= #
+
+# One long-lived, logged-in connection per consumer instead of a TLS
+# handshake + LOGIN + SELECT for every poll. Between polls the connection
+# sits in IDLE, so the server pushes new mail to us immediately.
+
+
+class MailboxConnection:
+
+    def __init__(self, mailbox="INBOX", server=IMAP_SERVER, user=EMAIL_USER, password=EMAIL_PASS,
+                 name="imap"):
+        self.mailbox = mailbox
+        self.server = server
+        self.user = user
+        self.password = password
+        self.name = name
+        self.mail = None
+        self.idle_supported = False
+        self.uidvalidity = None
+        self._failures = 0
+
+    # ---------- connection lifecycle ----------
+
+    def connect(self):
+        self.close()
+        mail = imaplib.IMAP4_SSL(self.server)
+        mail.login(self.user, self.password)
+        typ, _ = mail.select(self.mailbox)
+        if typ != "OK":
+            raise imaplib.IMAP4.error(f"cannot select {self.mailbox}")
+        self.mail = mail
+        self.idle_supported = "IDLE" in mail.capabilities
+        self.uidvalidity = self._uidvalidity()
+        print(f"📬 [{self.name}] connected to {self.server}/{self.mailbox}"
+              f"{' (IDLE)' if self.idle_supported else ' (NOOP polling)'}")
+        return mail
+
+    def _uidvalidity(self):
+        resp = self.mail.response("UIDVALIDITY")[1]
+        if resp and resp[0]:
+            return int(resp[0])
+        return None
+
+    def ensure(self):
+        """The logged-in connection, reconnecting with backoff if needed."""
+        while self.mail is None:
+            try:
+                self.connect()
+                self._failures = 0
+            except (imaplib.IMAP4.error, OSError) as e:
+                delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * 2 ** self._failures)
+                self._failures += 1
+                print(f"⚠️ [{self.name}] connect failed ({e}); retrying in {delay}s")
+                self.close()
+                time.sleep(delay)
+        return self.mail
+
+    def close(self):
+        if self.mail is None:
+            return
+        try:
+            self.mail.logout()
+        except Exception:
+            pass
+        self.mail = None
+
+    def drop(self):
+        """Forget a broken connection; the next ensure() reconnects."""
+        try:
+            self.mail.shutdown()
+        except Exception:
+            pass
+        self.mail = None
+
+    # ---------- waiting for mail ----------
+
+    def noop(self):
+        """Keepalive and health check; also surfaces pending EXISTS updates."""
+        typ, _ = self.ensure().noop()
+        if typ != "OK":
+            raise imaplib.IMAP4.abort("NOOP failed")
+
+    def wait(self, timeout=IMAP_IDLE_TIMEOUT):
+        """
+        Block until the server reports mailbox activity or timeout passes.
+        Returns True on activity. Any connection error drops the connection
+        (the next ensure() reconnects) and returns True so the caller
+        re-scans instead of trusting a dead socket.
+        """
+        try:
+            if not self.idle_supported:
+                time.sleep(min(timeout, IMAP_NOOP_INTERVAL))
+                self.noop()
+                return True
+            activity = self._idle(timeout)
+            if not activity:
+                self.noop()     # keepalive / health check before the next IDLE
+            return activity
+        except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError) as e:
+            print(f"⚠️ [{self.name}] connection lost while idle: {e}")
+            self.drop()
+            return True
+
+    def _idle(self, timeout):
+        mail = self.ensure()
+        tag = mail._new_tag()
+        mail.send(tag + b" IDLE\r\n")
+        line = mail.readline()
+        if not line.startswith(b"+"):
+            raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+        activity = False
+        deadline = time.monotonic() + timeout
+        sock = mail.socket()
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not _buffered(mail, sock):
+                    ready, _, _ = select.select([sock], [], [], remaining)
+                    if not ready:
+                        break
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed during IDLE")
+                # "* OK still here" style keepalives are not activity
+                if line.startswith(b"* ") and not line.startswith(b"* OK"):
+                    activity = True
+                    break
+        finally:
+            mail.send(b"DONE\r\n")
+            # Drain until the tagged completion of IDLE
+            while True:
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed ending IDLE")
+                if line.startswith(tag):
+                    break
+            mail.tagged_commands.pop(tag, None)
+        return activity
+
+
+def _buffered(mail, sock):
+    """
+    True if imaplib's reader already holds unread bytes. An EXISTS that
+    arrived with the "+ idling" continuation sits in mail.file's buffer
+    (or the TLS layer), where select() on the socket can't see it.
+    """
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+# ================= FETCH RESPONSES ================= #
+
+def _lex(data):
+    """Tokens of an IMAP response line: b"(", b")", atoms and strings."""
+    i, n = 0, len(data)
+    while i < n:
+        c = data[i:i + 1]
+        if c in b" \r\n":
+            i += 1
+        elif c in b"()":
+            yield c
+            i += 1
+        elif c == b'"':
+            out = bytearray()
+            i += 1
+            while i < n and data[i:i + 1] != b'"':
+                if data[i:i + 1] == b"\\":
+                    i += 1
+                out += data[i:i + 1]
+                i += 1
+            i += 1
+            yield ("str", bytes(out))
+        else:
+            # Atom; a [section] may contain spaces and parens (HEADER.FIELDS (FROM))
+            start, depth = i, 0
+            while i < n:
+                c = data[i:i + 1]
+                if c == b"[":
+                    depth += 1
+                elif c == b"]":
+                    depth -= 1
+                elif depth == 0 and c in b" ()\r\n":
+                    break
+                i += 1
+            yield data[start:i]
+
+
+def _tokens(data):
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            head = head[:head.rindex(b"{")] if head.endswith(b"}") else head
+            yield from _lex(head)
+            yield ("str", literal)
+        elif item:
+            yield from _lex(item)
+
+
+def _parse(tokens, tok):
+    if tok == b"(":
+        out = []
+        for t in tokens:
+            if t == b")":
+                return out
+            out.append(_parse(tokens, t))
+        return out
+    if isinstance(tok, tuple):
+        return tok[1]
+    if tok.upper() == b"NIL":
+        return None
+    return tok
+
+
+def parse_fetch(data):
+    """
+    imaplib FETCH/UID FETCH response data -> {uid: {ITEM: value}} with item
+    names upper-cased and the "BODY.PEEK" spelling folded to "BODY".
+    Literals (part contents) come back as bytes.
+    """
+    out = {}
+    tokens = _tokens(data)
+    for tok in tokens:
+        if tok in (b")", b"("):
+            continue
+        # "<seq> (" then key/value pairs
+        if not isinstance(tok, bytes) or not tok.isdigit():
+            continue
+        opener = next(tokens, None)
+        if opener != b"(":
+            continue
+        items = _parse(tokens, b"(")
+        fields = {}
+        for k, v in zip(items[::2], items[1::2]):
+            key = k.decode(errors="replace").upper().replace("BODY.PEEK", "BODY") if isinstance(k, bytes) else k
+            fields[key] = v
+        if "UID" in fields:
+            out[int(fields["UID"])] = fields
+    return out
+
+
+# ================= BODYSTRUCTURE ================= #
+
+def _s(v):
+    return v.decode(errors="replace") if isinstance(v, bytes) else (v or "")
+
+
+def _params(lst):
+    if not isinstance(lst, list):
+        return {}
+    return {_s(k).lower(): _s(v) for k, v in zip(lst[::2], lst[1::2])}
+
+
+def _filename(params, disp_params):
+    for source in (disp_params, params):
+        for key in ("filename", "name"):
+            if key in source:
+                return source[key]
+        # RFC 2231 encoded: filename*=utf-8''PO%20123.pdf
+        for key in ("filename*", "name*"):
+            if key in source:
+                return collapse_rfc2231_value(decode_rfc2231(source[key]))
+    return None
+
+
+def walk_bodystructure(bs, section=""):
+    """
+    Flatten a parsed BODYSTRUCTURE into leaf parts, descending into
+    attached messages:
+        {"section", "type", "charset", "encoding", "size", "disposition", "filename", "content_id"}
+    """
+    if not isinstance(bs, list) or not bs:
+        return []
+
+    if isinstance(bs[0], list):
+        # multipart: children, then subtype and extension data
+        parts = []
+        children = []
+        for c in bs:
+            if not isinstance(c, list):
+                break
+            children.append(c)
+        for i, child in enumerate(children):
+            parts.extend(walk_bodystructure(child, f"{section}.{i + 1}" if section else str(i + 1)))
+        return parts
+
+    ctype = f"{_s(bs[0])}/{_s(bs[1])}".lower()
+    section = section or "1"
+    if ctype == "message/rfc822" and len(bs) > 8 and isinstance(bs[8], list):
+        # Forwarded-as-attachment mail: walk its body. Its parts are n.1,
+        # n.2, ...; a single-part body is n.1 itself.
+        nested = bs[8]
+        return walk_bodystructure(nested, section if nested and isinstance(nested[0], list) else f"{section}.1")
+    params = _params(bs[2])
+    # Extension data starts after the type-specific fields
+    ext = 7
+    if ctype.startswith("text/"):
+        ext = 8
+    elif ctype == "message/rfc822":
+        ext = 10
+    disposition, disp_params = None, {}
+    if len(bs) > ext + 1 and isinstance(bs[ext + 1], list) and bs[ext + 1]:
+        disposition = _s(bs[ext + 1][0]).lower()
+        disp_params = _params(bs[ext + 1][1] if len(bs[ext + 1]) > 1 else None)
+
+    return [{
+        "section": section,
+        "type": ctype,
+        "charset": params.get("charset", "utf-8"),
+        "encoding": _s(bs[5]).lower(),
+        "size": int(bs[6]) if isinstance(bs[6], bytes) and bs[6].isdigit() else 0,
+        "disposition": disposition,
+        "filename": _filename(params, disp_params),
+        "content_id": _s(bs[3]) or None
+    }]
+
+
+# ================= PART CONTENT ================= #
+
+def iter_part(mail, uid, section, chunk_size=IMAP_PART_CHUNK):
+    """
+    Raw (still transfer-encoded) bytes of one body part, in BODY.PEEK[]<offset.length>
+    partial fetches, so a 25 MB attachment is never in memory at once.
+    """
+    offset = 0
+    while True:
+        typ, data = mail.uid("FETCH", str(uid), f"(BODY.PEEK[{section}]<{offset}.{chunk_size}>)")
+        if typ != "OK":
+            raise imaplib.IMAP4.error(f"FETCH {uid} BODY[{section}] failed: {data}")
+        fields = parse_fetch(data).get(uid, {})
+        # The item comes back as "BODY[2]<0>"
+        raw = next((v for k, v in fields.items() if k.startswith(f"BODY[{section}]")), None) or b""
+        if raw:
+            yield raw
+        if len(raw) < chunk_size:
+            return
+        offset += len(raw)
+
+
+class PartDecoder:
+    """
+    Incremental Content-Transfer-Encoding decoder: feed() raw chunks cut at
+    arbitrary points, get decoded bytes back; flush() at the end.
+    """
+
+    def __init__(self, encoding):
+        self.encoding = (encoding or "").lower()
+        self.pending = b""
+
+    def feed(self, raw):
+        if self.encoding == "base64":
+            buf = self.pending + raw.translate(None, b" \t\r\n")
+            cut = len(buf) - len(buf) % 4
+            self.pending = buf[cut:]
+            return base64.b64decode(buf[:cut])
+        if self.encoding == "quoted-printable":
+            # Only whole lines: a soft break or =XX escape may straddle chunks
+            buf = self.pending + raw
+            cut = buf.rfind(b"\n") + 1
+            self.pending = buf[cut:]
+            return quopri.decodestring(buf[:cut])
+        return raw
+
+    def flush(self):
+        pending, self.pending = self.pending, b""
+        if not pending:
+            return b""
+        if self.encoding == "base64":
+            return base64.b64decode(pending + b"=" * (-len(pending) % 4))
+        return quopri.decodestring(pending)
+
+
+def decode_part(raw, encoding):
+    decoder = PartDecoder(encoding)
+    return decoder.feed(raw) + decoder.flush()
@@ -0,0 +1,302 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from core import llm_client
+
+
+# ================= CONFIG ================= #
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Past replies with their final intent, one JSON object per line; the
+# local model is trained on these
+REPLY_LABELS = os.getenv("REPLY_LABELS", os.path.join(BASE_DIR, "reply_labels.jsonl"))
+
+INTENT_CACHE_SIZE = int(os.getenv("INTENT_CACHE_SIZE", "1024"))
+MODEL_MIN_LABELS = 20         # per class, before the local model is used
+MODEL_MIN_CONFIDENCE = 0.85   # below this the reply goes to the LLM
+MODEL_RETRAIN_EVERY = 10      # new labels before refitting
+
+INTENTS = ("APPROVE", "REJECT", "OTHER")
+
+# ========================================= #
+
+# Tiers, cheapest first; each one either decides or passes the reply on:
+#   1. memo       - same normalized body seen before (bounded LRU)
+#   2. exact      - whole reply is a known short answer ("yes", "cancel")
+#   3. lexicon    - answer phrases, reject over approve; questions, hedges and
+#                   negated approvals pass on (regressions: LEXICON_CASES)
+#   4. model      - TF-IDF + logistic regression on past labelled replies
+#   5. llm        - everything still ambiguous
+
+EXACT = {
+    "APPROVE": {
+        "yes", "y", "ok", "okay", "sure", "proceed", "go ahead", "approved", "approve",
+        "confirmed", "confirm", "ship it", "yes please", "yes proceed", "please proceed",
+        "fine", "agreed", "sounds good", "ship", "go", "yes go ahead", "ok proceed"
+    },
+    "REJECT": {
+        "no", "n", "cancel", "no thanks", "no thank you", "reject", "rejected", "decline",
+        "declined", "dont ship", "do not ship", "cancel it", "cancel order", "not needed",
+        "hold", "wait", "no please cancel"
+    }
+}
+
+# Questions and hedges are never decided by phrase: "not sure, let me check"
+# contains "sure", "can you confirm when..." contains "confirm"
+HEDGE_PHRASES = (
+    r"\?", r"\bnot sure\b", r"\bunsure\b", r"\blet me (check|confirm|ask|see|get back|discuss)",
+    r"\b(check|confirm|discuss) (with|internally)\b", r"\bget back to you\b", r"\bwill (let you know|revert)\b",
+    r"\b(maybe|perhaps|possibly)\b", r"\bnot yet\b", r"\bthink about\b", r"\bif\b"
+)
+# Take precedence over the approve phrases: "don't ship it", "not ok" contain approve words
+REJECT_PHRASES = (
+    r"\bdo ?n[o']?t (ship|proceed|send|dispatch|approve)", r"\bdont (ship|proceed|send|dispatch|approve)",
+    r"\bcancel", r"\bwait (for|until|till)\b", r"\bfull (stock|shipment|order|quantity) only\b",
+    r"\bonly (the )?(full|complete)\b", r"\bunless (it is |its )?(complete|full)\b",
+    r"\bnot (ok|okay|fine|interested|needed|required|acceptable|approved|confirmed)\b",
+    r"\bno,? (thanks|thank you)\b", r"\bdecline", r"\breject", r"\bhold (off|on)\b"
+)
+# Bare "ok", "sure", "fine", "confirm" and "no" only count as the whole
+# reply, which the exact tier handles
+APPROVE_PHRASES = (
+    r"\byes\b", r"\bgo ahead\b", r"\bproceed\b", r"\bship (it|them|the available|whatever|what)",
+    r"\bplease ship\b", r"\bwhatever is available\b", r"\bapproved?\b", r"\b(i|we) confirm\b",
+    r"\bconfirmed\b", r"\b(that's|that is|it's|its) (ok|okay|fine)\b", r"\bsend (the )?available\b",
+    r"\bpartial (is|shipment is) (fine|ok|okay)\b"
+)
+
+# A negation a few words before an approve verb: "we will not proceed",
+# "I can't approve", "no need to proceed". Passed on rather than guessed
+# as REJECT: "no reason not to proceed" is an approval.
+NEGATED_APPROVE = (
+    r"(\b(not|never|cannot|can ?t|won ?t|wouldn ?t|shouldn ?t|don ?t|didn ?t|unable to|no need to|rather not"
+    r"|no longer)\b|n't\b)( \S+){0,3}? (proceed|approve|ship|go ahead|confirm|accept|send|dispatch)"
+)
+
+# Lexicon regressions: reply -> verdict of lexicon_match (None: next tier).
+# Run scripts/test_reply.py after changing any phrase list.
+LEXICON_CASES = {
+    "I'm not sure, let me check with my manager": None,
+    "Can you confirm when the full stock arrives?": None,
+    "no problem": None,
+    "We will not proceed with the partial order": None,
+    "We won't proceed": None,
+    "No need to proceed": None,
+    "Not going to approve this": None,
+    "I can't approve a partial shipment": None,
+    "Please don't ship it": "REJECT",
+    "not ok": "REJECT",
+    "yes, but cancel item 2": "REJECT",
+    "No thanks, wait for full stock": "REJECT",
+    "Yes please go ahead and ship it": "APPROVE",
+    "Confirmed, send the available quantity": "APPROVE",
+}
+
+_HEDGE_RE = re.compile("|".join(HEDGE_PHRASES))
+_NEGATED_APPROVE_RE = re.compile(NEGATED_APPROVE)
+_REJECT_RE = re.compile("|".join(REJECT_PHRASES))
+_APPROVE_RE = re.compile("|".join(APPROVE_PHRASES))
+
+# Start of the quoted original in a reply ("On Mon, ... wrote:", "-----Original Message-----")
+_QUOTE_RE = re.compile(r"(?im)^(on .{0,200}wrote:|-+ ?original message ?-+|from: .+)$")
+
+_lock = threading.Lock()
+_memo = OrderedDict()
+_model = None
+_model_labels = None          # label count at the last fit attempt
+
+
+# ================= NORMALIZATION ================= #
+
+def reply_text(body):
+    """The customer's own words: quoted history and '>' lines removed."""
+    body = body or ""
+    m = _QUOTE_RE.search(body)
+    if m:
+        body = body[:m.start()]
+    return "\n".join(line for line in body.splitlines() if not line.lstrip().startswith(">"))
+
+
+def normalize(body):
+    text = reply_text(body).lower().replace("’", "'")
+    # "?" is kept: a question is never an answer (see HEDGE_PHRASES)
+    text = re.sub(r"[^a-z0-9'? ]+", " ", text)
+    return " ".join(text.split())[:500]
+
+
+def body_hash(normalized):
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+# ================= TIERS ================= #
+
+def exact_match(text):
+    key = text.replace("'", "")
+    for intent, answers in EXACT.items():
+        if key in answers:
+            return intent
+    return None
+
+
+def lexicon_match(text):
+    if _HEDGE_RE.search(text):
+        return None         # question or undecided: next tier
+    # Any reject phrase wins: "yes, but cancel item 2" must not ship
+    if _REJECT_RE.search(text):
+        return "REJECT"
+    if _NEGATED_APPROVE_RE.search(text):
+        return None         # negated approval: not safe to guess either way
+    if _APPROVE_RE.search(text):
+        return "APPROVE"
+    return None
+
+
+def load_labels():
+    labels = []
+    try:
+        with open(REPLY_LABELS) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                if row.get("intent") in INTENTS and row.get("text"):
+                    labels.append(row)
+    except OSError:
+        pass
+    return labels
+
+
+def record_label(body, intent, source):
+    """Append a labelled reply (LLM decision or manual review) for training."""
+    text = normalize(body)
+    if not text or intent not in INTENTS:
+        return
+    with _lock:
+        with open(REPLY_LABELS, "a") as f:
+            f.write(json.dumps({"text": text, "intent": intent, "source": source}) + "\n")
+
+
+def _train(labels):
+    try:
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.pipeline import make_pipeline
+    except ImportError:
+        return None
+
+    counts = {i: sum(1 for r in labels if r["intent"] == i) for i in ("APPROVE", "REJECT")}
+    if min(counts.values()) < MODEL_MIN_LABELS:
+        return None
+
+    model = make_pipeline(
+        TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True, min_df=1),
+        LogisticRegression(max_iter=1000, class_weight="balanced")
+    )
+    model.fit([r["text"] for r in labels], [r["intent"] for r in labels])
+    print(f"🧮 Reply intent model trained on {len(labels)} labelled replies")
+    return model
+
+
+def _current_model():
+    """Fit lazily, and refit once enough new labels have accumulated."""
+    global _model, _model_labels
+    labels = load_labels()
+    with _lock:
+        if _model_labels is None or len(labels) - _model_labels >= MODEL_RETRAIN_EVERY:
+            _model = _train(labels)
+            _model_labels = len(labels)
+        return _model
+
+
+def model_predict(text):
+    model = _current_model()
+    if model is None:
+        return None
+    proba = model.predict_proba([text])[0]
+    best = proba.argmax()
+    if proba[best] < MODEL_MIN_CONFIDENCE:
+        return None
+    return model.classes_[best]
+
+
+def llm_classify(body):
+    prompt = f"""
+    You are an AI assistant classifying customer replies regarding a Partial Order Proposal.
+
+    The customer was asked: "We have partial stock. Should we ship available items?"
+
+    Classify the following reply into exactly one of these categories:
+    - APPROVE (Customer wants us to ship available items, e.g., "Yes", "Go ahead", "Ship it", "Okay", "Proceed")
+    - REJECT (Customer does NOT want partial shipment, e.g., "No", "Cancel", "Wait for full stock", "Don't ship")
+    - OTHER (Unclear, asking for more info, or unrelated)
+
+    REPLY: "{reply_text(body)[:500]}"
+
+    OUTPUT ONLY THE CATEGORY NAME (APPROVE, REJECT, or OTHER). Do not add any explanation.
+    """
+
+    intent = llm_client.generate(
+        prompt,
+        options={"temperature": 0},  # Deterministic
+        timeout=30,
+        tag="reply_intent"
+    ).strip().upper()
+
+    # Cleanup potential extra text
+    if "APPROVE" in intent:
+        return "APPROVE"
+    if "REJECT" in intent:
+        return "REJECT"
+    return "OTHER"
+
+
+# ================= CLASSIFY ================= #
+
+def _remember(key, intent):
+    with _lock:
+        _memo[key] = intent
+        _memo.move_to_end(key)
+        while len(_memo) > INTENT_CACHE_SIZE:
+            _memo.popitem(last=False)
+
+
+def classify(body):
+    """
+    Classify a reply to a partial-stock proposal.
+    Returns (intent, tier) with intent one of APPROVE / REJECT / OTHER.
+    """
+    text = normalize(body)
+    if not text:
+        return "OTHER", "empty"
+
+    key = body_hash(text)
+    with _lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            return _memo[key], "memo"
+
+    for tier, match in (("exact", exact_match), ("lexicon", lexicon_match), ("model", model_predict)):
+        try:
+            intent = match(text)
+        except Exception as e:
+            print(f"⚠️ Intent tier {tier} failed: {e}")
+            intent = None
+        if intent:
+            _remember(key, intent)
+            return intent, tier
+
+    try:
+        intent = llm_classify(body)
+    except Exception as e:
+        print(f"LLM Classification Error: {e}")
+        return "OTHER", "llm"     # not memoized: retry the LLM next time
+
+    _remember(key, intent)
+    record_label(body, intent, "llm")
+    return intent, "llm"
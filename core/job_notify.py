@@ -0,0 +1,57 @@
+import os
+import select
+import socket
+
+
+# ================= CONFIG ================= #
+
+# Producers (ingestion) send a tiny UDP datagram to the OCR service whenever a
+# job is enqueued, so it wakes up immediately instead of polling the queue.
+# Plain localhost UDP works on both Linux and macOS.
+NOTIFY_HOST = "127.0.0.1"
+NOTIFY_PORT = int(os.getenv("OCR_NOTIFY_PORT", "8765"))
+# Same mechanism for routed customer replies (services/reply_listener.py)
+REPLY_NOTIFY_PORT = int(os.getenv("REPLY_NOTIFY_PORT", "8766"))
+
+# ========================================= #
+
+
+def notify(file_name="", port=NOTIFY_PORT):
+    """
+    Best-effort wakeup. Never raises: if nobody is listening the datagram is
+    dropped and the consumer picks the job up on its next safety sweep.
+    """
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.sendto(file_name.encode()[:512], (NOTIFY_HOST, port))
+    except OSError:
+        pass
+
+
+class JobListener:
+    """
+    Blocks on the notify socket with zero CPU while idle.
+    """
+
+    def __init__(self, host=NOTIFY_HOST, port=NOTIFY_PORT):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for a notification.
+        Drains every queued datagram (a burst of N jobs is one wakeup).
+        Returns True if woken by a notification, False on timeout.
+        """
+        ready, _, _ = select.select([self.sock], [], [], max(timeout, 0))
+        if not ready:
+            return False
+        while True:
+            try:
+                self.sock.recv(1024)
+            except BlockingIOError:
+                return True
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import sqlite3
+
+from core.job_notify import notify
+
+
+# ================= CONFIG ================= #
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUEUE_DB = os.getenv("JOB_QUEUE_DB", os.path.join(BASE_DIR, "jobs.db"))
+MANIFEST = os.path.join(BASE_DIR, "manifest.json")
+INCOMING = os.path.join(BASE_DIR, "incoming")
+
+MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+VISIBILITY_TIMEOUT = int(os.getenv("JOB_VISIBILITY_TIMEOUT", "600"))   # seconds
+RETRY_BACKOFF = 30        # seconds, multiplied by attempt number
+
+# ========================================= #
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    file_name       TEXT PRIMARY KEY,
+    status          TEXT NOT NULL DEFAULT 'pending',
+    email_metadata  TEXT,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    json_name       TEXT,
+    error           TEXT,
+    worker          TEXT,
+    visible_at      REAL NOT NULL,
+    created_at      REAL NOT NULL,
+    updated_at      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_visible ON jobs (status, visible_at);
+"""
+
+# Job lifecycle:
+#   pending    -> waiting to be claimed (visible once visible_at <= now)
+#   processing -> claimed by a worker; reclaimable when the lease (visible_at) expires
+#   processed  -> acked
+#   failed     -> out of attempts, file moved to failed/
+
+
+def get_connection():
+    # isolation_level=None: we issue BEGIN IMMEDIATE ourselves so a claim
+    # takes the write lock before reading, making it atomic across processes.
+    conn = sqlite3.connect(QUEUE_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def init_db():
+    conn = get_connection()
+    conn.executescript(SCHEMA)
+    conn.close()
+
+
+def _row_to_job(row):
+    job = dict(row)
+    job["email_metadata"] = json.loads(job["email_metadata"] or "{}")
+    return job
+
+
+# ================= PRODUCER ================= #
+
+def enqueue(file_name, email_metadata=None):
+    now = time.time()
+    conn = get_connection()
+    conn.execute("""
+        INSERT OR IGNORE INTO jobs (file_name, status, email_metadata, visible_at, created_at, updated_at)
+        VALUES (?, 'pending', ?, ?, ?, ?)
+    """, (file_name, json.dumps(email_metadata or {}), now, now, now))
+    conn.close()
+    notify(file_name)
+
+
+# ================= CONSUMER ================= #
+
+def claim(worker=None, visibility_timeout=VISIBILITY_TIMEOUT):
+    """
+    Atomically claim the oldest visible job.
+    Returns the job dict or None if the queue is empty.
+    """
+    now = time.time()
+    worker = worker or str(os.getpid())
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+
+        # Leases that expired on their last attempt: the worker died mid-job
+        # too many times, stop retrying.
+        conn.execute("""
+            UPDATE jobs SET status = 'failed', error = 'visibility timeout exceeded', updated_at = ?
+            WHERE status = 'processing' AND visible_at <= ? AND attempts >= ?
+        """, (now, now, MAX_ATTEMPTS))
+
+        row = conn.execute("""
+            SELECT * FROM jobs
+            WHERE status IN ('pending', 'processing') AND visible_at <= ?
+            ORDER BY created_at
+            LIMIT 1
+        """, (now,)).fetchone()
+
+        if not row:
+            conn.execute("COMMIT")
+            return None
+
+        conn.execute("""
+            UPDATE jobs
+            SET status = 'processing', attempts = attempts + 1,
+                worker = ?, visible_at = ?, updated_at = ?
+            WHERE file_name = ?
+        """, (worker, now + visibility_timeout, now, row["file_name"]))
+        conn.execute("COMMIT")
+
+        job = _row_to_job(row)
+        job["attempts"] += 1
+        return job
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def ack(file_name, json_name=None):
+    now = time.time()
+    conn = get_connection()
+    conn.execute("""
+        UPDATE jobs SET status = 'processed', json_name = ?, error = NULL, updated_at = ?
+        WHERE file_name = ?
+    """, (json_name, now, file_name))
+    conn.close()
+
+
+def fail(file_name, error, retry=True):
+    """
+    Record a failed attempt. The job goes back to pending with a backoff
+    while attempts remain, otherwise it is marked failed.
+    Returns True if the job will be retried.
+    """
+    now = time.time()
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT attempts FROM jobs WHERE file_name = ?", (file_name,)).fetchone()
+        attempts = row["attempts"] if row else MAX_ATTEMPTS
+
+        if retry and attempts < MAX_ATTEMPTS:
+            conn.execute("""
+                UPDATE jobs SET status = 'pending', error = ?, visible_at = ?, updated_at = ?
+                WHERE file_name = ?
+            """, (str(error), now + RETRY_BACKOFF * attempts, now, file_name))
+            retrying = True
+        else:
+            conn.execute("""
+                UPDATE jobs SET status = 'failed', error = ?, updated_at = ?
+                WHERE file_name = ?
+            """, (str(error), now, file_name))
+            retrying = False
+
+        conn.execute("COMMIT")
+        return retrying
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def requeue(file_name):
+    """Manually put a failed job back in the queue with a fresh attempt budget."""
+    now = time.time()
+    conn = get_connection()
+    conn.execute("""
+        UPDATE jobs SET status = 'pending', attempts = 0, error = NULL, visible_at = ?, updated_at = ?
+        WHERE file_name = ?
+    """, (now, now, file_name))
+    conn.close()
+    notify(file_name)
+
+
+# ================= QUERIES ================= #
+
+def get_job(file_name):
+    conn = get_connection()
+    row = conn.execute("SELECT * FROM jobs WHERE file_name = ?", (file_name,)).fetchone()
+    conn.close()
+    return _row_to_job(row) if row else None
+
+
+def next_visible_at():
+    """
+    Earliest time a pending retry or an in-flight lease becomes claimable,
+    or None if nothing is waiting. Lets consumers sleep exactly that long.
+    """
+    conn = get_connection()
+    row = conn.execute("""
+        SELECT MIN(visible_at) AS t FROM jobs WHERE status IN ('pending', 'processing')
+    """).fetchone()
+    conn.close()
+    return row["t"]
+
+
+def count_by_status():
+    conn = get_connection()
+    rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+    conn.close()
+    return {r["status"]: r["n"] for r in rows}
+
+
+# ================= MIGRATION ================= #
+
+def migrate_manifest(manifest_path=MANIFEST):
+    """
+    One-time import of the legacy manifest.json.
+    Pending entries whose file is no longer in incoming/ are stale and are
+    imported as failed instead of being polled forever. The manifest is
+    renamed afterwards so it isn't imported twice.
+    Returns the number of entries imported.
+    """
+    if not os.path.exists(manifest_path):
+        return 0
+
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Could not read manifest for migration: {e}")
+        return 0
+
+    init_db()
+    now = time.time()
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+
+    imported = 0
+    for file_name, entry in manifest.items():
+        status = entry.get("status", "pending")
+        error = entry.get("error")
+
+        if status == "pending" and not os.path.exists(os.path.join(INCOMING, file_name)):
+            status = "failed"
+            error = "file missing from incoming/ (stale manifest entry)"
+
+        cur = conn.execute("""
+            INSERT OR IGNORE INTO jobs (file_name, status, email_metadata, json_name, error,
+                                        visible_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            file_name, status, json.dumps(entry.get("email_metadata", {})),
+            entry.get("json"), error, now, now, now
+        ))
+        imported += cur.rowcount
+
+    conn.execute("COMMIT")
+    conn.close()
+
+    try:
+        os.rename(manifest_path, manifest_path + ".migrated")
+    except FileNotFoundError:
+        pass    # another service migrated it concurrently
+    print(f"📦 Migrated {imported} manifest entries into {os.path.basename(QUEUE_DB)}")
+    return imported
@@ -0,0 +1,353 @@
+import os
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:       # Windows: no cross-process slots
+    fcntl = None
+
+# Load local environment variables
+load_dotenv()
+
+
+# ================= CONFIG ================= #
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/generate")
+LLM_MODEL = os.getenv("LLM_MODEL", "qwen2.5:7b")
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Max concurrent requests this process sends to Ollama; extra callers wait
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "2"))
+# Max concurrent requests from all services together (OCR workers,
+# ingestion, agent, reply listener). 0 disables; not used behind the LLM
+# gateway, which does its own admission with priorities.
+OLLAMA_GLOBAL_SLOTS = int(os.getenv("OLLAMA_GLOBAL_SLOTS", "2"))
+LLM_SLOT_DIR = os.getenv("LLM_SLOT_DIR", os.path.join(BASE_DIR, "cache", "llm_slots"))
+LLM_GATEWAY_PORT = int(os.getenv("LLM_GATEWAY_PORT", "11500"))
+# Keep the model loaded between calls instead of Ollama's 5 minute default
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_RETRIES = int(os.getenv("OLLAMA_RETRIES", "2"))
+RETRY_BASE_DELAY = 1.0    # seconds, doubled per attempt, +/-50% jitter
+RETRY_MAX_DELAY = 15.0
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+# Queue lane per call tag, read by services/llm_gateway.py when OLLAMA_URL
+# points at it (plain Ollama ignores the headers). Unlisted tags: "normal".
+PRIORITY_LANES = {
+    "reply_intent": "interactive",
+    "po_extract": "normal",
+    "po_header": "normal",
+    "po_items": "normal",
+    "po_fix": "normal",
+    "email_polish": "batch",
+    "legacy": "batch"
+}
+
+# ========================================= #
+
+# One pooled session per process: TCP connections to Ollama are reused
+# across calls instead of a new connect per request.
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max(OLLAMA_MAX_CONCURRENCY, 4)))
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max(OLLAMA_MAX_CONCURRENCY, 4)))
+
+_slots = threading.BoundedSemaphore(OLLAMA_MAX_CONCURRENCY)
+
+_global_slots = 0 if fcntl is None or urlsplit(OLLAMA_URL).port == LLM_GATEWAY_PORT else OLLAMA_GLOBAL_SLOTS
+if _global_slots:
+    os.makedirs(LLM_SLOT_DIR, exist_ok=True)
+
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+class LLMError(Exception):
+    pass
+
+
+class _Retryable(Exception):
+    pass
+
+
+# ================= METRICS ================= #
+
+def _record(tag, seconds, ok, tokens=0):
+    with _metrics_lock:
+        m = _metrics.setdefault(tag, {
+            "calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0, "tokens": 0
+        })
+        m["calls"] += 1
+        m["errors"] += 0 if ok else 1
+        m["total_seconds"] += seconds
+        m["max_seconds"] = max(m["max_seconds"], seconds)
+        m["tokens"] += tokens
+
+
+def get_metrics():
+    """Per-tag call counts and latency, e.g. for logs or the dashboard."""
+    with _metrics_lock:
+        out = {}
+        for tag, m in _metrics.items():
+            out[tag] = dict(m, avg_seconds=round(m["total_seconds"] / m["calls"], 3) if m["calls"] else 0)
+        return out
+
+
+# ================= ADMISSION ================= #
+
+# Cross-process slots are lock files: a call holds an exclusive flock on
+# one of OLLAMA_GLOBAL_SLOTS files while it runs. The kernel drops the lock
+# when a process dies, so a crashed OCR worker can't leak a slot.
+
+@contextmanager
+def _global_slot():
+    if not _global_slots:
+        yield
+        return
+    delay = 0.05
+    while True:
+        for i in range(_global_slots):
+            f = open(os.path.join(LLM_SLOT_DIR, f"slot{i}.lock"), "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+            return
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+@contextmanager
+def _admission():
+    """A local slot (threads of this process), then a global one."""
+    with _slots, _global_slot():
+        yield
+
+
+# ================= CLIENT ================= #
+
+def _backoff(attempt):
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    time.sleep(delay * random.uniform(0.5, 1.5))
+
+
+def _headers(tag, timeout):
+    return {
+        "X-LLM-Priority": PRIORITY_LANES.get(tag, "normal"),
+        "X-LLM-Deadline": str(timeout),
+        "X-LLM-Tag": tag
+    }
+
+
+def _post(payload, timeout, tag):
+    """One attempt, holding an admission slot for its whole duration."""
+    with _admission():
+        t0 = time.perf_counter()
+        try:
+            res = _session.post(OLLAMA_URL, json=payload, timeout=timeout, headers=_headers(tag, timeout))
+            if res.status_code in RETRYABLE_STATUS:
+                raise _Retryable(f"Ollama HTTP {res.status_code}")
+            res.raise_for_status()
+            body = res.json()
+        except Exception:
+            _record(tag, time.perf_counter() - t0, ok=False)
+            raise
+
+        elapsed = time.perf_counter() - t0
+        _record(tag, elapsed, ok=True, tokens=body.get("eval_count", 0))
+        print(f"🧠 LLM [{tag}] {elapsed:.2f}s, {body.get('eval_count', 0)} tokens")
+        return body
+
+
+def generate(prompt, model=LLM_MODEL, options=None, timeout=60, tag="generate",
+             retries=OLLAMA_RETRIES, **extra):
+    """
+    Non-streaming /api/generate call. Returns the response text.
+
+    Connection errors and 429/5xx are retried with jittered exponential
+    backoff; a timeout is not (the same prompt would just time out again).
+    Raises LLMError when all attempts fail.
+    """
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": options or {},
+        **extra
+    }
+
+    last_error = None
+    for attempt in range(retries + 1):
+        try:
+            return _post(payload, timeout, tag).get("response", "")
+        except (requests.ConnectionError, _Retryable) as e:
+            last_error = e
+            if attempt < retries:
+                print(f"🔁 LLM [{tag}] attempt {attempt + 1} failed: {e}")
+                _backoff(attempt)
+        except Exception as e:
+            raise LLMError(f"[{tag}] {e}") from e
+
+    raise LLMError(f"[{tag}] failed after {retries + 1} attempts: {last_error}")
+
+
+# ================= STREAMING JSON ================= #
+
+class JSONStreamParser:
+    """
+    Incremental scanner for the first top-level JSON object in a token
+    stream. feed() returns the object's text as soon as its closing brace
+    arrives, and raises LLMError as soon as the output can no longer be
+    a JSON object (rambling preamble, runaway nesting or size).
+    """
+
+    def __init__(self, max_preamble=200, max_chars=50000, max_depth=12):
+        self.max_preamble = max_preamble
+        self.max_chars = max_chars
+        self.max_depth = max_depth
+        self.preamble = ""
+        self.parts = []
+        self.size = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, chunk):
+        for ch in chunk:
+            if self.depth == 0:
+                if ch == "{":
+                    self.depth = 1
+                    self.parts.append(ch)
+                    self.size = 1
+                    continue
+                # Whitespace or a ```json fence fit easily; chatty preambles don't
+                self.preamble += ch
+                if len(self.preamble) > self.max_preamble:
+                    raise LLMError(f"no JSON object after {len(self.preamble)} chars: {self.preamble[:80]!r}")
+                continue
+
+            self.parts.append(ch)
+            self.size += 1
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.depth += 1
+                if self.depth > self.max_depth:
+                    raise LLMError("JSON nesting too deep")
+            elif ch in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    return "".join(self.parts)
+
+            if self.size > self.max_chars:
+                raise LLMError(f"JSON object exceeded {self.max_chars} chars")
+        return None
+
+
+def generate_json(prompt, model=LLM_MODEL, options=None, timeout=120, tag="generate_json",
+                  retries=OLLAMA_RETRIES, **extra):
+    """
+    Streaming /api/generate call that returns the first JSON object in the
+    output as a dict.
+
+    Tokens are parsed as they arrive; the moment the top-level object
+    closes the connection is dropped, which makes Ollama stop generating,
+    so trailing commentary costs neither time nor tokens. Output that
+    can't be a JSON object is aborted early with LLMError.
+    """
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "stream": True,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": options or {},
+        **extra
+    }
+
+    last_error = None
+    for attempt in range(retries + 1):
+        try:
+            return _stream_json(payload, timeout, tag)
+        except (requests.ConnectionError, _Retryable) as e:
+            last_error = e
+            if attempt < retries:
+                print(f"🔁 LLM [{tag}] attempt {attempt + 1} failed: {e}")
+                _backoff(attempt)
+        except LLMError:
+            raise
+        except Exception as e:
+            raise LLMError(f"[{tag}] {e}") from e
+
+    raise LLMError(f"[{tag}] failed after {retries + 1} attempts: {last_error}")
+
+
+def _stream_json(payload, timeout, tag):
+    with _admission():
+        t0 = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        parser = JSONStreamParser()
+        tokens = 0
+        res = None
+        try:
+            # timeout here bounds connect and each read; deadline bounds the total
+            res = _session.post(OLLAMA_URL, json=payload, timeout=timeout, stream=True,
+                                headers=_headers(tag, timeout))
+            if res.status_code in RETRYABLE_STATUS:
+                raise _Retryable(f"Ollama HTTP {res.status_code}")
+            res.raise_for_status()
+
+            for line in res.iter_lines():
+                if not line:
+                    continue
+                msg = json.loads(line)
+                if msg.get("error"):
+                    raise LLMError(f"[{tag}] Ollama error: {msg['error']}")
+                tokens += 1
+                obj = parser.feed(msg.get("response", ""))
+                if obj is not None:
+                    elapsed = time.perf_counter() - t0
+                    _record(tag, elapsed, ok=True, tokens=tokens)
+                    print(f"🧠 LLM [{tag}] {elapsed:.2f}s, {tokens} tokens (stream closed at end of JSON)")
+                    return json.loads(obj)
+                if msg.get("done"):
+                    break
+                if time.monotonic() > deadline:
+                    raise LLMError(f"[{tag}] timed out after {timeout}s")
+
+            raise LLMError(f"[{tag}] stream ended without a complete JSON object")
+        except LLMError as e:
+            _record(tag, time.perf_counter() - t0, ok=False, tokens=tokens)
+            if not str(e).startswith(f"[{tag}]"):
+                raise LLMError(f"[{tag}] {e}") from e
+            raise
+        except Exception:
+            _record(tag, time.perf_counter() - t0, ok=False, tokens=tokens)
+            raise
+        finally:
+            if res is not None:
+                # Closing mid-stream drops the connection: Ollama cancels the generation
+                res.close()
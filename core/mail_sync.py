@@ -0,0 +1,162 @@
+import os
+import time
+
+from core.job_queue import get_connection
+from core.job_notify import notify, REPLY_NOTIFY_PORT
+
+
+# ================= CONFIG ================= #
+
+# Attempts at routing one message before it is left for a human
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "5"))
+
+# ========================================= #
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mail_cursors (
+    consumer        TEXT NOT NULL,
+    mailbox         TEXT NOT NULL,
+    uidvalidity     INTEGER,
+    last_uid        INTEGER NOT NULL DEFAULT 0,
+    updated_at      REAL NOT NULL,
+    PRIMARY KEY (consumer, mailbox)
+);
+CREATE TABLE IF NOT EXISTS replies (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    uidvalidity     INTEGER,
+    uid             INTEGER NOT NULL,
+    from_email      TEXT,
+    subject         TEXT,
+    body            TEXT,
+    status          TEXT NOT NULL DEFAULT 'pending',
+    intent          TEXT,
+    po_number       TEXT,
+    created_at      REAL NOT NULL,
+    updated_at      REAL NOT NULL,
+    UNIQUE (uidvalidity, uid)
+);
+CREATE INDEX IF NOT EXISTS idx_replies_status ON replies (status);
+CREATE TABLE IF NOT EXISTS mail_failures (
+    consumer        TEXT NOT NULL,
+    mailbox         TEXT NOT NULL,
+    uidvalidity     INTEGER,
+    uid             INTEGER NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 1,
+    error           TEXT,
+    updated_at      REAL NOT NULL,
+    PRIMARY KEY (consumer, mailbox, uidvalidity, uid)
+);
+"""
+
+# Mail is fetched once, by the router in services/email_ingestion_imap.py,
+# which remembers per consumer how far it has read the mailbox: UIDs only
+# grow within one UIDVALIDITY, so "UID > last_uid" is exactly the new mail.
+# No \Seen flags are involved, so a human reading the inbox can't hide
+# mail from the pipeline and one service can't steal another's messages.
+#
+# The cursor moves past a message that failed to route (bad part, DB
+# error), so one broken mail can't block the mailbox; the UID is kept in
+# mail_failures and retried on the next polls until MAIL_MAX_ATTEMPTS.
+#
+# Replies to our partial-stock proposals are handed to the reply listener
+# through the replies table:
+#   pending -> handled   (APPROVE / REJECT acted on)
+#           -> review    (unclear intent or no PO number; never refetched)
+#           -> failed    (handler raised)
+
+
+def init_db():
+    conn = get_connection()
+    conn.executescript(SCHEMA)
+    conn.close()
+
+
+# ================= SYNC CURSORS ================= #
+
+def get_cursor(consumer, mailbox):
+    """(uidvalidity, last_uid); (None, 0) if this consumer never synced."""
+    conn = get_connection()
+    row = conn.execute(
+        "SELECT uidvalidity, last_uid FROM mail_cursors WHERE consumer = ? AND mailbox = ?",
+        (consumer, mailbox)
+    ).fetchone()
+    conn.close()
+    return (row["uidvalidity"], row["last_uid"]) if row else (None, 0)
+
+
+def set_cursor(consumer, mailbox, uidvalidity, last_uid):
+    conn = get_connection()
+    conn.execute("""
+        INSERT INTO mail_cursors (consumer, mailbox, uidvalidity, last_uid, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (consumer, mailbox) DO UPDATE SET
+            uidvalidity = excluded.uidvalidity,
+            last_uid = excluded.last_uid,
+            updated_at = excluded.updated_at
+    """, (consumer, mailbox, uidvalidity, last_uid, time.time()))
+    conn.close()
+
+
+def record_failure(consumer, mailbox, uidvalidity, uid, error):
+    conn = get_connection()
+    conn.execute("""
+        INSERT INTO mail_failures (consumer, mailbox, uidvalidity, uid, error, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (consumer, mailbox, uidvalidity, uid) DO UPDATE SET
+            attempts = attempts + 1,
+            error = excluded.error,
+            updated_at = excluded.updated_at
+    """, (consumer, mailbox, uidvalidity, uid, str(error)[:500], time.time()))
+    conn.close()
+
+
+def clear_failure(consumer, mailbox, uidvalidity, uid):
+    conn = get_connection()
+    conn.execute(
+        "DELETE FROM mail_failures WHERE consumer = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?",
+        (consumer, mailbox, uidvalidity, uid)
+    )
+    conn.close()
+
+
+def retry_uids(consumer, mailbox, uidvalidity, max_attempts=MAIL_MAX_ATTEMPTS):
+    """Failed UIDs of the current UIDVALIDITY still worth another attempt."""
+    conn = get_connection()
+    rows = conn.execute("""
+        SELECT uid FROM mail_failures
+        WHERE consumer = ? AND mailbox = ? AND uidvalidity = ? AND attempts < ?
+        ORDER BY uid
+    """, (consumer, mailbox, uidvalidity, max_attempts)).fetchall()
+    conn.close()
+    return [r["uid"] for r in rows]
+
+
+# ================= REPLIES ================= #
+
+def enqueue_reply(uidvalidity, uid, from_email, subject, body):
+    now = time.time()
+    conn = get_connection()
+    conn.execute("""
+        INSERT OR IGNORE INTO replies (uidvalidity, uid, from_email, subject, body, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (uidvalidity, uid, from_email, subject, body, now, now))
+    conn.close()
+    notify(str(uid), port=REPLY_NOTIFY_PORT)
+
+
+def pending_replies(limit=50):
+    conn = get_connection()
+    rows = conn.execute(
+        "SELECT * FROM replies WHERE status = 'pending' ORDER BY id LIMIT ?", (limit,)
+    ).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+def finish_reply(reply_id, status, intent=None, po_number=None):
+    conn = get_connection()
+    conn.execute("""
+        UPDATE replies SET status = ?, intent = ?, po_number = ?, updated_at = ?
+        WHERE id = ?
+    """, (status, intent, po_number, time.time(), reply_id))
+    conn.close()
@@ -0,0 +1,153 @@
+import os
+import copy
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import cv2
+
+
+# ================= CONFIG ================= #
+
+# Max page images run through the models together, and how long the first
+# page of a batch may wait for others to join it.
+OCR_BATCH_PAGES = int(os.getenv("OCR_BATCH_PAGES", "4"))
+OCR_BATCH_WAIT_MS = int(os.getenv("OCR_BATCH_WAIT_MS", "50"))
+
+# ========================================= #
+
+get_rotate_crop_image = None
+sorted_boxes = None
+
+
+def _supports_batching(engine):
+    # PaddleOCR 2.x internals used to split det/rec into separate stages.
+    # Imported here, not at module level, so importing this module does not
+    # pull in paddle.
+    global get_rotate_crop_image, sorted_boxes
+    if get_rotate_crop_image is None:
+        try:
+            from paddleocr.tools.infer.utility import get_rotate_crop_image
+            from paddleocr.tools.infer.predict_system import sorted_boxes
+        except ImportError:
+            return False
+    return hasattr(engine, "text_detector") and hasattr(engine, "text_recognizer")
+
+
+def run_batch(engine, images):
+    """
+    OCR several grayscale page images in one go.
+
+    Detection runs per image (its input size depends on the page), then the
+    text crops of *all* pages are recognized in a single batched call, which
+    is where CPU inference gains the most. Returns one result per image in
+    the same shape as PaddleOCR.ocr(): [[[box, (text, score)], ...]].
+    """
+    if not _supports_batching(engine):
+        return [engine.ocr(img, cls=False) for img in images]
+
+    crops = []
+    boxes_per_image = []
+    for img in images:
+        bgr = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR) if img.ndim == 2 else img
+        dt_boxes, _ = engine.text_detector(bgr)
+        if dt_boxes is None or len(dt_boxes) == 0:
+            boxes_per_image.append([])
+            continue
+        dt_boxes = sorted_boxes(dt_boxes)
+        boxes_per_image.append(dt_boxes)
+        for box in dt_boxes:
+            crops.append(get_rotate_crop_image(bgr, copy.deepcopy(box)))
+        del bgr
+
+    rec_res = []
+    if crops:
+        rec_res, _ = engine.text_recognizer(crops)
+
+    drop_score = getattr(engine, "drop_score", 0.5)
+    results = []
+    i = 0
+    for dt_boxes in boxes_per_image:
+        lines = []
+        for box in dt_boxes:
+            text, score = rec_res[i]
+            i += 1
+            if score >= drop_score:
+                lines.append([box.tolist(), (text, score)])
+        results.append([lines])
+    return results
+
+
+class OCRBatcher:
+    """
+    Collects page images submitted from any thread (pages of one document,
+    or of several documents processed concurrently in this process) and runs
+    them through the OCR models in batches.
+
+    A batch is flushed when it reaches max_batch pages or when its first
+    page has waited max_wait seconds, so latency under light load stays low.
+    Only the batcher thread touches the engine, which also makes OCR safe to
+    call from multiple document threads.
+    """
+
+    def __init__(self, engine, max_batch=OCR_BATCH_PAGES, max_wait=OCR_BATCH_WAIT_MS / 1000):
+        self.engine = engine
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.busy = False
+        self.thread = threading.Thread(target=self._loop, name="ocr-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        fut = Future()
+        self.queue.put((image, fut))
+        return fut
+
+    def ocr(self, image):
+        return self.submit(image).result()
+
+    def idle(self):
+        return self.queue.empty() and not self.busy
+
+    def close(self):
+        """Stop the thread after the pages already queued have been OCR'd."""
+        self.queue.put(None)
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.engine = None
+                return
+            self.busy = True
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)    # close after this batch
+                    break
+                batch.append(item)
+            self._run(batch)
+            self.busy = False
+
+    def _run(self, batch):
+        try:
+            t0 = time.perf_counter()
+            results = run_batch(self.engine, [img for img, _ in batch])
+            if len(batch) > 1:
+                print(f"🧮 OCR batch of {len(batch)} pages in {time.perf_counter() - t0:.2f}s")
+            for (_, fut), res in zip(batch, results):
+                fut.set_result(res)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
@@ -0,0 +1,129 @@
+import os
+import gc
+import time
+import threading
+
+from core.ocr_batcher import OCRBatcher
+
+
+# ================= CONFIG ================= #
+
+# Release the OCR model after this many idle seconds (0 = keep forever)
+OCR_IDLE_RELEASE = int(os.getenv("OCR_IDLE_RELEASE", "600"))
+REAPER_INTERVAL = 30      # seconds
+
+# ========================================= #
+
+# The PaddleOCR model is only built when the first scanned page needs it.
+# Digital-only PDFs, and every module that merely imports the OCR worker,
+# never pay the model load.
+#
+# Fork safety: the engine itself is kept across fork(), so workers forked
+# after preload() share the loaded weights copy-on-write. Threads and locks
+# do not survive fork(), so the child starts a fresh batcher thread around
+# the inherited engine (see _after_fork).
+
+_lock = threading.Lock()
+_engine = None
+_batcher = None
+_last_used = 0.0
+_reaper = None
+
+
+def _build_engine():
+    from paddleocr import PaddleOCR     # heavy import, deferred on purpose
+
+    t0 = time.perf_counter()
+    # Optimized PaddleOCR Settings
+    # use_angle_cls=False for speed if orientation is fixed
+    # det_limit_side_len=1280 caps the detector input for faster processing of large images
+    # rec_batch_num: text crops recognized per forward pass (see core/ocr_batcher.py)
+    engine = PaddleOCR(
+        lang="en", use_angle_cls=False,
+        det_limit_side_len=1280, det_limit_type="max",
+        rec_batch_num=16
+    )
+    print(f"🧠 PaddleOCR loaded in {time.perf_counter() - t0:.1f}s (PID {os.getpid()})")
+    return engine
+
+
+def _ensure_batcher():
+    # Caller holds _lock
+    global _engine, _batcher, _reaper
+    if _engine is None:
+        _engine = _build_engine()
+    if _batcher is None:
+        _batcher = OCRBatcher(_engine)
+    if OCR_IDLE_RELEASE > 0 and _reaper is None:
+        _reaper = threading.Thread(target=_reap_idle, name="ocr-reaper", daemon=True)
+        _reaper.start()
+    return _batcher
+
+
+def preload():
+    """
+    Load the model now, e.g. in a parent process right before forking
+    workers so they share it copy-on-write.
+    """
+    global _engine, _last_used
+    with _lock:
+        if _engine is None:
+            _engine = _build_engine()
+        _last_used = time.monotonic()
+
+
+def submit(image):
+    """Queue a page image for OCR; returns a Future of the PaddleOCR result."""
+    global _last_used
+    with _lock:
+        batcher = _ensure_batcher()
+        _last_used = time.monotonic()
+        return batcher.submit(image)
+
+
+def ocr(image):
+    return submit(image).result()
+
+
+def release():
+    """Drop the model (after queued pages finish) and return its memory."""
+    global _engine, _batcher
+    with _lock:
+        if _batcher is not None:
+            _batcher.close()
+        _batcher = None
+        _engine = None
+    gc.collect()
+
+
+def _reap_idle():
+    global _engine, _batcher, _reaper
+    while True:
+        time.sleep(REAPER_INTERVAL)
+        with _lock:
+            if _engine is None:
+                _reaper = None
+                return
+            idle_for = time.monotonic() - _last_used
+            if idle_for < OCR_IDLE_RELEASE or (_batcher is not None and not _batcher.idle()):
+                continue
+            if _batcher is not None:
+                _batcher.close()
+            _batcher = None
+            _engine = None
+            _reaper = None
+        gc.collect()
+        print(f"💤 PaddleOCR released after {int(idle_for)}s idle (PID {os.getpid()})")
+        return
+
+
+def _after_fork():
+    # Keep the (copy-on-write) engine, rebuild everything thread-based.
+    global _lock, _batcher, _reaper
+    _lock = threading.Lock()
+    _batcher = None
+    _reaper = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -1,10 +1,14 @@
 
+import re
 import json
+import threading
 import psycopg2
+from string import Template
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from config.db_config import DB_CONFIG
 from core.invoice_generator import generate_invoice_for_po
-import requests
+from core import llm_client
 import os
 from dotenv import load_dotenv
 
@@ -17,7 +21,6 @@ load_dotenv()
 
 # Mock Email (Print to console) or Real SMTP can be swapped here
 ENABLE_EMAIL = True 
-OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/generate")
 
 EMAIL_SIGNATURE = """
 Involexis
@@ -178,20 +181,125 @@ def reconstruct_decisions(items, stock_map):
     return decisions
 
 # ============================================================
-# LLM HELPER (for Email Body)
+# EMAIL TEMPLATES
 # ============================================================
 
-def generate_email_body(prompt):
-    full_prompt = f"{prompt}\n\nIMPORTANT: Do NOT include any signature or closing like 'Best regards', '[Your Name]', etc. Just write the body of the email. I will add the signature automatically."
+# Bodies are rendered from these templates, so sending an email never waits
+# on the LLM. With EMAIL_LLM_POLISH=1 a per-buyer reworded copy of a
+# template is generated in the background; emails use it once it exists.
+
+EMAIL_LLM_POLISH = os.getenv("EMAIL_LLM_POLISH", "0") == "1"
+EMAIL_POLISH_CACHE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "email_polish.json"
+)
+
+EMAIL_TEMPLATES = {
+    "invoice": """Dear $buyer,
+
+Thank you for your Purchase Order $po_number. We are pleased to confirm that all items are in stock and your order is being processed.
+
+Please find the invoice for this order attached. Do let us know if you have any questions.""",
+
+    "apology": """Dear $buyer,
+
+Thank you for your Purchase Order $po_number. Unfortunately, the items on this order are currently out of stock and we are unable to fulfil it at this time.
+
+We apologise for the inconvenience and will be glad to help as soon as stock is replenished.""",
+
+    "partial_proposal": """Dear $buyer,
+
+Thank you for your Purchase Order $po_number. We currently have partial stock available for your order:
+
+$item_list
+
+Would you like us to proceed with shipping these available items now? Please reply to confirm, and we will generate the invoice and ship immediately.""",
+
+    "partial_confirmed": """Dear $buyer,
+
+Thank you for confirming. We are shipping the available items on Purchase Order $po_number, and the invoice for this partial shipment is attached."""
+}
+
+_polish_lock = threading.Lock()
+_polished = None            # {"outcome|buyer": template}, loaded on first use
+_polish_pending = set()
+_polish_executor = None
+
+
+def _polish_key(outcome, buyer):
+    return f"{outcome}|{(buyer or '').strip().lower()}"
+
+
+def _load_polished():
+    # Caller holds _polish_lock
+    global _polished
+    if _polished is None:
+        try:
+            with open(EMAIL_POLISH_CACHE) as f:
+                _polished = json.load(f)
+        except (OSError, ValueError):
+            _polished = {}
+    return _polished
+
+
+def _polish_template(outcome, buyer):
+    """Background job: reword a template for one buyer and cache it."""
+    key = _polish_key(outcome, buyer)
+    template = EMAIL_TEMPLATES[outcome]
     try:
-        res = requests.post(OLLAMA_URL, json={
-            "model": "qwen2.5:7b",
-            "prompt": full_prompt,
-            "stream": False
-        }, timeout=30)
-        return res.json().get("response", "").strip()
-    except:
-        return "Please find the attached invoice."
+        placeholders = sorted(set(re.findall(r"\$\w+", template)))
+        prompt = f"""Rewrite this email template for our customer {buyer} in a warm, professional tone.
+Keep every placeholder ({", ".join(placeholders)}) exactly as written and keep the meaning unchanged.
+Do NOT include any signature or closing like 'Best regards'. Return only the email body.
+
+{template}"""
+        text = llm_client.generate(prompt, timeout=60, tag="email_polish", retries=1).strip()
+
+        # Reject rewrites that dropped or invented placeholders
+        if sorted(set(re.findall(r"\$\w+", text))) != placeholders:
+            print(f"⚠️ Discarded polished '{outcome}' template for {buyer}: placeholders changed")
+            return
+
+        with _polish_lock:
+            cache = _load_polished()
+            cache[key] = text
+            os.makedirs(os.path.dirname(EMAIL_POLISH_CACHE), exist_ok=True)
+            tmp = f"{EMAIL_POLISH_CACHE}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(cache, f, indent=2)
+            os.replace(tmp, EMAIL_POLISH_CACHE)
+        print(f"✨ Polished '{outcome}' template cached for {buyer}")
+    except Exception as e:
+        print(f"⚠️ Email polish failed for {buyer}: {e}")
+    finally:
+        with _polish_lock:
+            _polish_pending.discard(key)
+
+
+def render_email(outcome, header, **fields):
+    """
+    Email body for an outcome ("invoice", "apology", "partial_proposal",
+    "partial_confirmed"). Uses the buyer's polished template if one is
+    cached, otherwise the stock template (and queues a polish if enabled).
+    """
+    global _polish_executor
+    buyer = header.get("buyer") or "Customer"
+    template = EMAIL_TEMPLATES[outcome]
+
+    if EMAIL_LLM_POLISH:
+        key = _polish_key(outcome, buyer)
+        with _polish_lock:
+            polished = _load_polished().get(key)
+            if polished:
+                template = polished
+            elif key not in _polish_pending:
+                _polish_pending.add(key)
+                if _polish_executor is None:
+                    _polish_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="email-polish")
+                _polish_executor.submit(_polish_template, outcome, buyer)
+
+    return Template(template).safe_substitute(
+        buyer=buyer, po_number=header.get("po_number", ""), **fields
+    )
 
 # ============================================================
 # SMTP EMAIL SENDER
@@ -294,8 +402,7 @@ def handle_partial_response(po_id_or_num, decision):
         pdf_path = generate_invoice_for_po(po_id, header, available_items)
         print(f"📄 Partial Invoice Generated: {pdf_path}")
         
-        body = generate_email_body(f"Write a thank you email to {header['buyer']} confirming partial shipment for PO {header['po_number']}.")
-        body = generate_email_body(f"Write a thank you email to {header['buyer']} confirming partial shipment for PO {header['po_number']}.")
+        body = render_email("partial_confirmed", header)
         send_email(header.get("buyer_email"), f"Confirmed: Partial Shipment for PO {header['po_number']}", body, pdf_path)
         
         update_po_status(po_id, "PARTIAL_COMPLETED")
@@ -336,7 +443,7 @@ def process_po(po_id):
         print(f"📄 Invoice Generated: {pdf_path}")
         
         # Send Email
-        body = generate_email_body(f"Write a professional email to {header['buyer']} attaching invoice for PO {header['po_number']}.")
+        body = render_email("invoice", header)
         send_email(header.get("buyer_email"), f"Invoice for PO {header['po_number']}", body, pdf_path)
         
         update_po_status(po_id, "COMPLETED")
@@ -344,7 +451,7 @@ def process_po(po_id):
     elif all_none:
         print("❌ No Stock Available. Sending Apology.")
         
-        body = generate_email_body(f"Write a polite apology email to {header['buyer']} for PO {header['po_number']} stating items are out of stock.")
+        body = render_email("apology", header)
         send_email(header.get("buyer_email"), f"Update on PO {header['po_number']}", body)
         
         update_po_status(po_id, "FAILED_NO_STOCK")
@@ -364,20 +471,7 @@ def process_po(po_id):
         # NEW FLOW: Don't generate invoice yet. Send email listing available items.
         item_list = "\n".join([f"- {d['product_name']}: {d['allocatable']} units" for d in available_items])
         
-        prompt = f"""
-        Dear {header['buyer']},
-
-        Write a professional email regarding Purchase Order {header['po_number']}.
-        Inform them that we currently have partial stock available for their order.
-        
-        Available Items:
-        {item_list}
-
-        Ask them if they would like us to proceed with shipping these available items now. 
-        Mention that we will generate the invoice and ship immediately upon their confirmation.
-        """
-        
-        body = generate_email_body(prompt)
+        body = render_email("partial_proposal", header, item_list=item_list)
         send_email(header.get("buyer_email"), f"Update: Partial Stock for PO {header['po_number']}", body)
         
         update_po_status(po_id, "WAITING_FOR_REPLY")
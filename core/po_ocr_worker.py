@@ -1,15 +1,28 @@
 import os
 import json
 import shutil
-import requests
+import time
+import tempfile
+import zipfile
+from xml.etree import ElementTree
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pdfplumber
-import numpy as np
 import cv2
 
-from pdf2image import convert_from_path
-from paddleocr import PaddleOCR
+from pdf2image import convert_from_path, pdfinfo_from_path
 
 from core.db_insert import insert_po
+from core import job_queue
+from core import llm_client
+from core import extraction_cache
+from core import po_templates
+from core import po_schema
+from core import extraction_checks
+from core import ocr_engine
+from core.ocr_batcher import OCR_BATCH_PAGES
+from core.image_preprocess import preprocess_page
+from core.table_extract import digital_page_tables, ocr_page_layout, build_llm_input, split_llm_chunks
 
 
 # ================= CONFIG ================= #
@@ -21,10 +34,17 @@ INCOMING = os.path.join(BASE_DIR, "incoming")
 PROCESSING = os.path.join(BASE_DIR, "processing")
 OUTPUT = os.path.join(BASE_DIR, "processed_json")
 FAILED = os.path.join(BASE_DIR, "failed")
-MANIFEST = os.path.join(BASE_DIR, "manifest.json")
 
-OLLAMA_URL = "http://localhost:11434/api/generate"
-LLM_MODEL = "qwen2.5:7b"
+LLM_MODEL = llm_client.LLM_MODEL
+LLM_MAX_CTX = int(os.getenv("LLM_MAX_CTX", "8192"))
+# Longer LLM inputs are extracted in chunks of about this size, in parallel
+LLM_CHUNK_CHARS = int(os.getenv("LLM_CHUNK_CHARS", "6000"))
+LLM_CHUNK_WORKERS = int(os.getenv("LLM_CHUNK_WORKERS", str(llm_client.OLLAMA_MAX_CONCURRENCY)))
+
+# Pages read per document (0 = all); a safety cap, large POs are chunked
+MAX_PAGES = int(os.getenv("OCR_MAX_PAGES", "50"))
+OCR_DPI = int(os.getenv("OCR_DPI", "150"))         # lower DPI for speed
+DIGITAL_MIN_CHARS = 100   # below this a page with an image is treated as scanned
 
 # ========================================= #
 
@@ -32,171 +52,609 @@ os.makedirs(PROCESSING, exist_ok=True)
 os.makedirs(OUTPUT, exist_ok=True)
 os.makedirs(FAILED, exist_ok=True)
 
-# Optimized PaddleOCR Settings
-# use_angle_cls=False for speed if orientation is fixed
-# limit_side_len=1280 for faster processing of large images
-ocr = PaddleOCR(lang="en", use_angle_cls=False)
-
+# The PaddleOCR model is loaded lazily by core/ocr_engine.py on the first
+# scanned page, not at import time.
 
 
-# ================= MANIFEST ================= #
+# ================= JOB FILES ================= #
 
-def load_manifest():
+def stage_file(file_name):
+    """
+    Move a claimed job's file from incoming/ to processing/.
+    A retried job is already in processing/ from its previous attempt.
+    Returns the processing path, or None if the file is gone.
+    """
+    proc = os.path.join(PROCESSING, file_name)
     try:
-        with open(MANIFEST) as f:
-            return json.load(f)
-    except:
-        return {}
+        os.rename(os.path.join(INCOMING, file_name), proc)
+    except FileNotFoundError:
+        if not os.path.exists(proc):
+            return None
+    return proc
 
 
-def save_manifest(m):
-    with open(MANIFEST, "w") as f:
-        json.dump(m, f, indent=2)
+# ================= OCR ================= #
 
+def ocr_result_lines(result):
+    """Flatten a PaddleOCR result into [(box, text, score)]."""
+    lines = []
+    for page in result or []:
+        for res in page or []:
+            lines.append((res[0], res[1][0], res[1][1]))
+    return lines
 
-# ================= OCR ================= #
 
-def extract_text_from_pdf(pdf_path):
+def apply_ocr_result(entry, result):
     """
-    1. Try digital PDF text extraction
-    2. Fallback to PaddleOCR for scanned PDFs
+    Fill a page entry from its OCR result: line text rebuilt from box rows,
+    plus tables recovered from box columns (see core/table_extract.py).
     """
-    print(f"📄 Extracting text from: {os.path.basename(pdf_path)}")
+    lines = ocr_result_lines(result)
+    text, body, tables = ocr_page_layout(lines)
+    entry["text"] = text
+    entry["body"] = body
+    entry["tables"] = tables
+    entry["lines"] = lines
+    entry["chars"] = len(text)
+
+
+def iter_page_images(pdf_path, page_numbers, dpi=OCR_DPI):
+    """
+    Rasterize pages one at a time and yield (page_no, gray) pairs.
+
+    pdftoppm renders each page straight to an 8-bit grayscale PGM on disk,
+    which cv2 reads into a single numpy array: no RGB PIL image, no extra
+    np.array/cvtColor copies, and only one page is alive at a time.
+    """
+    with tempfile.TemporaryDirectory(prefix="ocr_") as tmp:
+        for page_no in page_numbers:
+            try:
+                paths = convert_from_path(
+                    pdf_path, dpi=dpi, first_page=page_no, last_page=page_no,
+                    grayscale=True, fmt="ppm", output_folder=tmp, paths_only=True
+                )
+            except Exception as e:
+                print(f"⚠️ Could not rasterize page {page_no}: {e}")
+                return
+            if not paths:
+                return      # past the last page
+
+            gray = cv2.imread(paths[0], cv2.IMREAD_GRAYSCALE)
+            os.remove(paths[0])
+            if gray is not None:
+                yield page_no, gray
+
+
+def is_image_only(page, text):
+    """
+    A page needs OCR when pdfplumber finds (almost) no text on it but it does
+    carry an image, i.e. it is a scan. A short digital page with no images
+    (e.g. a signature page) stays digital.
+    """
+    if len(text.strip()) > DIGITAL_MIN_CHARS:
+        return False
+    return bool(page.images)
+
+
+def extract_pages(pdf_path, max_pages=MAX_PAGES):
+    """
+    Per-page hybrid extraction.
+    Digital pages are read with pdfplumber, only image-only pages are
+    rasterized (one at a time) and OCR'd. Returns one dict per page:
+        {"page", "method", "chars", "seconds", "text"}
+    """
+    pages = {}
+    scanned = []
     try:
         with pdfplumber.open(pdf_path) as pdf:
-            first_page_text = pdf.pages[0].extract_text() or ""
-            # If we get enough text digitally, skip heavy OCR
-            if len(first_page_text.strip()) > 100:
-                print("⚡ Using digital text extraction (Fast)")
-                return "\n".join(p.extract_text() or "" for p in pdf.pages[:3])
+            for page_no, page in enumerate(pdf.pages[:max_pages or None], start=1):
+                t0 = time.perf_counter()
+                try:
+                    text = page.extract_text() or ""
+                except Exception as e:
+                    print(f"⚠️ Digital extraction failed on page {page_no}: {e}")
+                    text = ""
+
+                entry = {"page": page_no, "method": "digital", "text": text}
+                if is_image_only(page, text):
+                    entry["method"] = "ocr"
+                    scanned.append(page_no)
+                else:
+                    body, tables = digital_page_tables(page)
+                    if tables:
+                        entry["body"] = body
+                        entry["tables"] = tables
+
+                entry["chars"] = len(text)
+                entry["seconds"] = round(time.perf_counter() - t0, 3)
+                pages[page_no] = entry
+                # Drop pdfplumber's cached layout objects for this page
+                if hasattr(page, "close"):
+                    page.close()
     except Exception as e:
-        print(f"⚠️ Digital extraction failed: {e}")
+        # pdfplumber can't parse the file at all: OCR every page we can rasterize
+        print(f"⚠️ Digital extraction failed: {e}. Falling back to Scanned OCR (Slower)...")
+        pages = {}
+        try:
+            page_count = pdfinfo_from_path(pdf_path)["Pages"]
+        except Exception:
+            page_count = max_pages or 1
+        scanned = list(range(1, min(page_count, max_pages or page_count) + 1))
+
+    # Streaming OCR: rasterize -> preprocess -> OCR -> free. Up to OCR_BATCH_PAGES pages
+    # are in flight so the batcher can group them (with pages from other
+    # documents in this process); memory stays bounded by that window.
+    in_flight = deque()
+
+    def collect():
+        page_no, fut, raster_seconds, submitted = in_flight.popleft()
+        entry = pages[page_no]
+        apply_ocr_result(entry, fut.result())
+        entry["seconds"] = round(entry["seconds"] + raster_seconds + time.perf_counter() - submitted, 3)
+
+    t0 = time.perf_counter()
+    for page_no, gray in iter_page_images(pdf_path, scanned):
+        gray, prep = preprocess_page(gray)
+        entry = pages.setdefault(page_no, {"page": page_no, "method": "ocr", "seconds": 0})
+        entry.update(prep)
+
+        if gray is None:
+            # Blank page: nothing to OCR and nothing for the LLM
+            entry["method"] = "blank"
+            entry["text"] = ""
+            entry["chars"] = 0
+            entry["seconds"] = round(entry["seconds"] + time.perf_counter() - t0, 3)
+            t0 = time.perf_counter()
+            continue
+
+        submitted = time.perf_counter()
+        in_flight.append((page_no, ocr_engine.submit(gray), submitted - t0, submitted))
+        del gray
+        if len(in_flight) >= OCR_BATCH_PAGES:
+            collect()
+        t0 = time.perf_counter()
+
+    while in_flight:
+        collect()
+
+    return [pages[k] for k in sorted(pages)]
+
+
+def extract_image_pages(image_path):
+    """
+    Photos / scans attached directly: read straight into grayscale and OCR,
+    no PDF round trip.
+    """
+    t0 = time.perf_counter()
+    gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError(f"Unreadable image: {os.path.basename(image_path)}")
+
+    gray, prep = preprocess_page(gray)
+    entry = {"page": 1, "method": "ocr", **prep}
+    if gray is None:
+        entry["method"] = "blank"
+        entry["text"] = ""
+        entry["chars"] = 0
+    else:
+        apply_ocr_result(entry, ocr_engine.ocr(gray))
+        del gray
 
-    print("🖼️ Digital extraction yielded little text. Falling back to Scanned OCR (Slower)...")
-    text = ""
-    # Use multiple threads for PDF conversion and lower DPI for speed
-    images = convert_from_path(pdf_path, dpi=150, first_page=1, last_page=3, thread_count=4)
+    entry["seconds"] = round(time.perf_counter() - t0, 3)
+    return [entry]
 
-    for i, img in enumerate(images):
-        print(f"📸 Processing page {i+1}...")
-        gray = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2GRAY)
-        # Use simple OCR call for speed
-        result = ocr.ocr(gray, cls=False)
-        if result:
-            for line in result:
-                if line:
-                    for res in line:
-                        text += res[1][0] + " "
-                    text += "\n"
 
-    return text
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def _docx_paragraph_text(p):
+    parts = []
+    for el in p.iter():
+        if el.tag == W_NS + "t" and el.text:
+            parts.append(el.text)
+        elif el.tag == W_NS + "tab":
+            parts.append("\t")
+        elif el.tag in (W_NS + "br", W_NS + "cr"):
+            parts.append("\n")
+    return "".join(parts)
+
+
+def _docx_xml_text(xml_bytes):
+    """
+    Body text in document order. Table rows become one line each with
+    cells separated by " | ", so line items stay on a single line.
+    """
+    root = ElementTree.fromstring(xml_bytes)
+    body = root.find(W_NS + "body")
+    if body is None:
+        body = root     # header/footer parts have no <w:body>
+
+    lines = []
+    for block in body:
+        if block.tag == W_NS + "p":
+            lines.append(_docx_paragraph_text(block))
+        elif block.tag == W_NS + "tbl":
+            for row in block.iter(W_NS + "tr"):
+                cells = []
+                for cell in row.findall(W_NS + "tc"):
+                    cells.append(" ".join(
+                        _docx_paragraph_text(p) for p in cell.iter(W_NS + "p")
+                    ).strip())
+                lines.append(" | ".join(cells))
+    return "\n".join(line for line in lines if line.strip())
+
+
+def extract_docx_pages(docx_path):
+    """
+    DOCX is a zip of XML: read the text directly, no OCR at all.
+    Headers come first since that is where PO numbers and letterheads live.
+    """
+    t0 = time.perf_counter()
+    with zipfile.ZipFile(docx_path) as z:
+        names = z.namelist()
+        parts = sorted(n for n in names if n.startswith("word/header") and n.endswith(".xml"))
+        parts.append("word/document.xml")
+        parts += sorted(n for n in names if n.startswith("word/footer") and n.endswith(".xml"))
+
+        texts = [_docx_xml_text(z.read(n)) for n in parts if n in names]
+
+    text = "\n".join(t for t in texts if t)
+    return [{
+        "page": 1,
+        "method": "docx",
+        "chars": len(text),
+        "seconds": round(time.perf_counter() - t0, 3),
+        "text": text
+    }]
+
+
+# Cheapest extraction path per attachment type
+EXTRACTORS = {
+    ".pdf": extract_pages,
+    ".jpg": extract_image_pages,
+    ".jpeg": extract_image_pages,
+    ".png": extract_image_pages,
+    ".docx": extract_docx_pages,
+}
+
+
+def extract_document(path):
+    ext = os.path.splitext(path)[1].lower()
+    extractor = EXTRACTORS.get(ext)
+    if extractor is None:
+        raise ValueError(f"Unsupported file type: {ext or os.path.basename(path)}")
+    return extractor(path)
+
+
+def page_report(pages):
+    """Pages without their text and layout, for logs and the output JSON."""
+    report = []
+    for p in pages:
+        r = {k: v for k, v in p.items() if k not in ("text", "body", "lines", "tables")}
+        if p.get("tables"):
+            r["table_rows"] = sum(len(t) for t in p["tables"])
+        report.append(r)
+    return report
+
+
+def log_pages(pages):
+    for p in pages:
+        icon = {"digital": "⚡", "docx": "📝", "blank": "⬜"}.get(p["method"], "🖼️")
+        print(f"{icon} Page {p['page']}: {p['method']} ({p['chars']} chars, {p['seconds']}s)")
+
+
+def extract_text_from_pdf(pdf_path):
+    """
+    Extract text page by page:
+    1. Digital pages via pdfplumber (Fast)
+    2. Image-only pages via PaddleOCR (Slower)
+    """
+    print(f"📄 Extracting text from: {os.path.basename(pdf_path)}")
+    pages = extract_pages(pdf_path)
+    log_pages(pages)
+    return "\n".join(p["text"] for p in pages)
 
 
 
 
 # ================= LLM ================= #
 
-def extract_po_with_llm(text):
-    prompt = f"""
-You are extracting structured Purchase Order data from noisy OCR text.
+def context_size(prompt):
+    """
+    Ollama context window sized to the prompt (~3 chars per token plus room
+    for the JSON answer), so short POs don't pay for a large KV cache and
+    long ones are not silently truncated at the default window.
+    """
+    needed = len(prompt) // 3 + 1024
+    num_ctx = 2048
+    while num_ctx < needed and num_ctx < LLM_MAX_CTX:
+        num_ctx *= 2
+    return num_ctx
 
-CRITICAL RULES:
+
+EXTRACTION_RULES = """CRITICAL RULES:
 - Return ONLY valid JSON
 - Do NOT hallucinate values
-- If a field is missing, return empty string ""
+- If a text field is missing, return empty string ""; if a number is missing, return null
 - Do NOT mix fields (dates must not appear as quantity)
-- Monetary fields must contain ONLY numbers (no commas, no currency symbols)
-- Preserve vendor text in raw fields
-
-RETURN JSON IN THIS EXACT STRUCTURE:
+- Monetary fields must be plain JSON numbers (no commas, no currency symbols)
+- Preserve vendor text in raw fields"""
 
-{{
-  "po_number": "",
-  "po_date": "",
-  "buyer": {{
-    "company_name": "",
-    "gst_number": "",
-    "address": "",
-    "email": ""
-  }},
-  "seller": {{
-    "company_name": "",
-    "gst_number": "",
-    "address": ""
-  }},
-  "currency": "",
-  "total_amount": "",
-  "line_items": [
-    {{
-      "product_id": "",
-      "product_identifier_raw": "",
-      "product_identifier_type": "",
-      "description": "",
-      "unit": "",
-      "quantity": "",
-      "unit_price": "",
-      "line_total": ""
-    }}
-  ]
-}}
-
-FIELD GUIDELINES:
+FIELD_GUIDELINES = """FIELD GUIDELINES:
 - product_id: internal identifier if present, else empty
 - product_identifier_raw: vendor-provided code, SAC/HSN, or combined text
 - product_identifier_type: classify raw identifier (e.g. HSN/SAC, SKU, Service Description)
 - quantity: numeric quantity only
+- po_date: as written on the document
 - unit_price, line_total, total_amount: numeric only
-- currency: ISO code like INR, USD
+- currency: ISO code like INR, USD"""
+
+TASKS = {
+    "po_extract": "Tables are given as rows with cells separated by \" | \". Extract EVERY table row that is a line item.",
+    "po_header": "This is the first and last page of a long PO. Extract ONLY the header fields below (no line items); "
+                 "total_amount is the grand total of the whole PO.",
+    "po_items": "This is one part of a long PO. Tables are given as rows with cells separated by \" | \". "
+                "Extract EVERY line item row in this part; skip header, subtotal and total rows.",
+    "po_fix": "An earlier extraction of this PO failed validation on the values listed below. Re-read ONLY these "
+              "values carefully from the document. Do not repeat a listed value unless the document really shows it."
+}
+
+
+def llm_extract(text, spec=po_schema.PO_SCHEMA, tag="po_extract", details=""):
+    prompt = f"""
+You are extracting structured Purchase Order data from noisy OCR text.
+{TASKS[tag]}
+{details}
+
+{EXTRACTION_RULES}
+
+RETURN JSON IN THIS EXACT STRUCTURE:
+
+{po_schema.prompt_structure(spec)}
+
+{FIELD_GUIDELINES}
 
 OCR TEXT:
-{text[:4500]}
+{text}
 """
 
-    response = requests.post(
-        OLLAMA_URL,
-        json={
-            "model": LLM_MODEL,
-            "prompt": prompt,
-            "stream": False,
-            "options": {"temperature": 0}
-        },
-        timeout=120
+    # Streamed: generation is cut off as soon as the JSON object closes,
+    # and non-JSON output is aborted within the first couple hundred chars.
+    return llm_client.generate_json(
+        prompt,
+        model=LLM_MODEL,
+        options={"temperature": 0, "num_ctx": context_size(prompt)},
+        timeout=120,
+        tag=tag,
+        # Constrained decoding: the model can only emit schema-shaped JSON
+        format=po_schema.json_schema(spec)
     )
 
-    raw = response.json()["response"]
-    return json.loads(raw[raw.find("{"): raw.rfind("}") + 1])
 
+def extract_po_with_llm(text):
+    return llm_extract(text)
 
-# ================= MAIN WORKER ================= #
 
-def run_ocr(file_name):
-    manifest = load_manifest()
+def merge_chunks(header, chunk_items):
+    """
+    Header fields plus the line items of every chunk, in document order.
+    Chunks never share rows (see split_llm_chunks), so identical items in
+    different chunks are real repeats (same SKU on two delivery schedules)
+    and all are kept.
+    """
+    merged = dict(header)
+    merged["line_items"] = [item for items in chunk_items for item in items]
+    return merged
 
-    if file_name not in manifest:
-        return
 
-    if manifest[file_name]["status"] != "pending":
-        return
+def header_input(pages):
+    """Header fields live on the first and last page."""
+    ends = [pages[0], pages[-1]] if len(pages) > 1 else pages
+    return build_llm_input(ends)[:LLM_CHUNK_CHARS]
 
-    src = os.path.join(INCOMING, file_name)
-    if not os.path.exists(src):
-        return
 
-    print(f"OCR started for: {file_name}")
+def extract_po_chunked(pages):
+    """
+    Map-reduce extraction for POs too long for one prompt: header fields
+    from the first and last page, line items from each chunk, all in
+    parallel, then merged. Wall time is about that of the largest chunk.
+    """
+    chunks = split_llm_chunks(pages, LLM_CHUNK_CHARS)
+    print(f"🧩 Chunked extraction: {len(chunks)} item chunk(s) + header")
 
-    proc = os.path.join(PROCESSING, file_name)
-    shutil.move(src, proc)
+    with ThreadPoolExecutor(max_workers=LLM_CHUNK_WORKERS) as pool:
+        header_f = pool.submit(llm_extract, header_input(pages), po_schema.HEADER_SCHEMA, "po_header")
+        item_fs = [pool.submit(llm_extract, c, po_schema.ITEMS_SCHEMA, "po_items") for c in chunks]
+        header = header_f.result()
+        chunk_items = [f.result().get("line_items") or [] for f in item_fs]
+
+    return merge_chunks(header, chunk_items)
+
+
+def fix_context(pages, data, spec, rows):
+    """
+    The document text a po_fix prompt needs. A long PO would overflow the
+    context and lose the rows listed at the top, so only the header pages
+    (for scalar fields) and the chunks holding the suspect rows are sent.
+    None when even that is larger than LLM_CHUNK_CHARS.
+    """
+    full = build_llm_input(pages, text_budget=None)
+    if len(full) <= LLM_CHUNK_CHARS:
+        return full
+
+    parts = []
+    if any(f != "line_items" for f in spec):
+        parts.append(header_input(pages))
+    wanted = [" ".join(str(data["line_items"][i].get("description") or "").lower().split()) for i in rows]
+    for chunk in split_llm_chunks(pages, LLM_CHUNK_CHARS):
+        text = " ".join(chunk.lower().split())
+        if any(d and d in text for d in wanted):
+            parts.append(chunk)
+    context = "\n\n".join(parts)
+    return context if context and len(context) <= LLM_CHUNK_CHARS else None
+
+
+def reextract_suspect(data, report, pages):
+    """
+    Ask the LLM again for only the fields that failed validation (see
+    core/extraction_checks.py) and keep the answers if they validate
+    better. Returns (data, report, re-extracted field paths).
+    """
+    rows = extraction_checks.suspect_rows(report)
+    spec = {f: po_schema.PO_SCHEMA[f] for f in ("po_number", "total_amount") if f in report["suspect"]}
+    if rows:
+        spec["line_items"] = [dict(
+            row=po_schema.NUMBER, description=po_schema.TEXT,
+            **{f: po_schema.NUMBER for f in extraction_checks.ITEM_NUMBERS}
+        )]
+    if not spec:
+        return data, report, []
+
+    listing = [f"- {f}: {data.get(f)!r}" for f in spec if f != "line_items"]
+    for i in rows:
+        item = data["line_items"][i]
+        values = ", ".join(f"{f}={item.get(f)!r}" for f in extraction_checks.ITEM_NUMBERS)
+        listing.append(f"- line item row {i + 1} ({item.get('description')!r}): {values}")
+    details = "\n".join(listing) + "\nReturn line items with their row number as listed."
+
+    context = fix_context(pages, data, spec, rows)
+    if context is None:
+        print("🔎 Suspect fields span too much of the document to re-extract; keeping the first result")
+        return data, report, []
+
+    print(f"🔎 Re-extracting {len(report['suspect'])} suspect field(s)")
+    fixed = llm_extract(context, spec, "po_fix", details)
+
+    candidate = json.loads(json.dumps(data))    # deep copy
+    for f in spec:
+        if f != "line_items" and fixed.get(f) not in (None, ""):
+            candidate[f] = fixed[f]
+    for item in fixed.get("line_items") or []:
+        row = po_schema.to_number(item.get("row"))
+        if row is None or int(row) - 1 not in rows:
+            continue
+        target = candidate["line_items"][int(row) - 1]
+        for f in extraction_checks.ITEM_NUMBERS:
+            n = po_schema.to_number(item.get(f))
+            if n is not None:
+                target[f] = n
+
+    candidate, _ = po_schema.normalize(candidate)
+    new_report = extraction_checks.validate(candidate, pages)
+    better = (len(new_report["suspect"]) < len(report["suspect"])
+              or report["needs_review"] and not new_report["needs_review"])
+    if not better:
+        print("🔎 Re-extraction did not improve validation; keeping the first result")
+        return data, report, []
+
+    changed = sorted(set(report["suspect"]) - set(new_report["suspect"]))
+    print(f"✅ Re-extraction fixed: {', '.join(changed) or 'review status'}")
+    return candidate, new_report, report["suspect"]
+
+
+def extract_po(pages, llm_input):
+    """One LLM call when the document fits, chunked map-reduce otherwise."""
+    # Judge the untrimmed size: llm_input's free text is cut to LLM_TEXT_BUDGET
+    if len(build_llm_input(pages, text_budget=None)) > LLM_CHUNK_CHARS:
+        return extract_po_chunked(pages)
+    return extract_po_with_llm(llm_input)
 
-    try:
-        text = extract_text_from_pdf(proc)
-        print(f"OCR text length: {len(text)}")
 
-        extracted_data = extract_po_with_llm(text)
+# ================= MAIN WORKER ================= #
+
+def run_ocr(job):
+    """
+    Process one claimed job from core.job_queue and ack/fail it.
+    """
+    file_name = job["file_name"]
+
+    proc = stage_file(file_name)
+    if not proc:
+        job_queue.fail(file_name, "file missing from incoming/ and processing/", retry=False)
+        return
+
+    print(f"OCR started for: {file_name} (attempt {job['attempts']})")
+
+    try:
+        # Ingestion hashes attachments while writing them
+        digest = job.get("email_metadata", {}).get("sha256") or extraction_cache.file_sha256(proc)
+        cached = extraction_cache.get(digest)
+
+        # Same bytes already extracted and inserted: forwarded thread / re-send
+        if cached and cached.get("inserted"):
+            print(f"♻️ Duplicate of {cached.get('file_name')} (sha256 {digest[:12]}). Skipping insert.")
+            # The original keeps the same bytes; this copy is not a job's file anymore
+            os.remove(proc)
+            job_queue.ack(file_name, cached.get("json_name"))
+            return
+
+        if cached and cached.get("extracted_data"):
+            # Extracted before but never inserted (e.g. DB was down): reuse it
+            print(f"⚡ Extraction cache hit (sha256 {digest[:12]})")
+            pages = cached["pages"]
+            extracted_data = cached["extracted_data"]
+            model = cached.get("llm_model", LLM_MODEL)
+            validation = cached.get("validation", {})
+        else:
+            print(f"📄 Extracting text from: {file_name}")
+            pages = extract_document(proc)
+            log_pages(pages)
+            text = "\n".join(p["text"] for p in pages)
+            llm_input = build_llm_input(pages)
+            print(f"OCR text length: {len(text)} (LLM input: {len(llm_input)})")
+
+            # Known layout: compiled rules, no LLM call
+            extracted_data, template_id = po_templates.try_extract(pages)
+            if extracted_data:
+                print(f"🧩 Extracted with template {template_id} (LLM skipped)")
+                model = f"template:{template_id}"
+            else:
+                extracted_data = extract_po(pages, llm_input)
+                model = LLM_MODEL
+
+            extracted_data, issues = po_schema.normalize(extracted_data)
+            for issue in issues:
+                print(f"⚠️ Dropped invalid value: {issue}")
+
+            # Per-field confidence and cross-checks; fix only what fails
+            report = extraction_checks.validate(extracted_data, pages)
+            reextracted = []
+            if report["suspect"] and model == LLM_MODEL:
+                try:
+                    extracted_data, report, reextracted = reextract_suspect(
+                        extracted_data, report, pages
+                    )
+                except Exception as e:
+                    print(f"⚠️ Re-extraction failed: {e}")
+            validation = dict(report, reextracted=reextracted)
+            if validation["needs_review"]:
+                print(f"🚩 Needs review: {', '.join(report['suspect']) or 'failed cross-check'}")
+            elif model == LLM_MODEL:
+                # Only learn layouts from results that passed validation
+                try:
+                    po_templates.learn(pages, extracted_data)
+                except Exception as e:
+                    print(f"⚠️ Template learning failed: {e}")
+
+            pages = page_report(pages)
+
+            extraction_cache.put(
+                digest,
+                file_name=file_name,
+                text=text,
+                pages=pages,
+                llm_model=model,
+                extracted_data=extracted_data,
+                validation=validation
+            )
 
         final_json = {
             "file_name": file_name,
-            "email_metadata": manifest[file_name].get("email_metadata", {}),
-            "llm_model": LLM_MODEL,
+            "email_metadata": job.get("email_metadata", {}),
+            "llm_model": model,
+            "sha256": digest,
+            "extraction": pages,
+            "validation": validation,
             "extracted_data": extracted_data
         }
 
@@ -205,18 +663,16 @@ def run_ocr(file_name):
             json.dump(final_json, f, indent=2)
 
         insert_po(final_json)
+        extraction_cache.put(digest, inserted=True, json_name=json_name)
 
-        manifest[file_name]["status"] = "processed"
-        manifest[file_name]["json"] = json_name
-        save_manifest(manifest)
+        job_queue.ack(file_name, json_name)
 
         print(f"OCR completed successfully: {file_name}")
 
     except Exception as e:
         print(f"OCR failed for {file_name}: {e}")
 
-        manifest[file_name]["status"] = "failed"
-        manifest[file_name]["error"] = str(e)
-        save_manifest(manifest)
-
-        shutil.move(proc, os.path.join(FAILED, file_name))
\ No newline at end of file
+        if job_queue.fail(file_name, e):
+            print(f"🔁 Will retry {file_name} later")
+        else:
+            shutil.move(proc, os.path.join(FAILED, file_name))
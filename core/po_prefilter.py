@@ -0,0 +1,201 @@
+import os
+import re
+import zipfile
+from collections import deque
+
+import pdfplumber
+
+
+# ================= CONFIG ================= #
+
+MIN_PO_SCORE = int(os.getenv("PO_PREFILTER_MIN_SCORE", "3"))    # weighted signals
+
+# Images smaller than this are logos, signatures and tracking pixels
+IMAGE_MIN_SIDE = int(os.getenv("PO_PREFILTER_IMAGE_MIN_SIDE", "400"))     # pixels
+IMAGE_MIN_BYTES = 15 * 1024
+
+PDF_PROBE_PAGES = 2
+PROBE_MIN_CHARS = 100     # less text than this: scanned, let OCR decide
+
+# Signal -> (weight, phrases). A document scores the weights of the
+# distinct signals it contains.
+SIGNALS = {
+    "purchase_order": (2, ("purchase order", "po no", "po number", "po #", "p.o. no", "po date")),
+    "bill_to": (1, ("bill to", "ship to", "billing address", "delivery address")),
+    "supplier": (1, ("supplier",)),
+    "vendor": (1, ("vendor",)),
+    "total": (1, ("total",)),
+    "amount": (1, ("amount",)),
+    "price": (1, ("price", "unit rate")),
+    "quantity": (1, ("quantity", "qty")),
+    "gst": (1, ("gst", "hsn")),
+    "item": (1, ("item",)),
+    "service": (1, ("service",))
+}
+
+# Image names that are never POs (branding). Whole words only:
+# "Silicon_Traders" is not an icon.
+BRANDING_NAME_RE = re.compile(
+    r"(?i)(^|[^a-z])(logo|signature|banner|icon|facebook|twitter|linkedin|instagram|youtube)([^a-z]|$)"
+)
+# Default names from mail clients and phones (image001.png, IMG_1234.JPG,
+# "WhatsApp Image ....jpeg"). A photographed PO has one of these too, so
+# they are only skipped when embedded in the HTML body (Content-ID).
+DEFAULT_IMAGE_NAME_RE = re.compile(r"(?i)^((image|img|outlook|att)[-_ ]?\d+|whatsapp image\b.*)\.(png|jpe?g)$")
+# File names that say PO outright: content probes can't reject these
+PO_NAME_RE = re.compile(r"(?i)(^|[^a-z])(po|p\.o|purchase|order|indent)([^a-z]|$)")
+
+IMAGE_EXT = (".jpg", ".jpeg", ".png")
+
+# ========================================= #
+
+# Runs in ingestion, before anything is queued for OCR. Every check is
+# cheap: the name and size from BODYSTRUCTURE before download, then an
+# image header, the PDF text layer of the first pages or the DOCX XML.
+# Anything the checks can't judge (scanned PDFs, unreadable files) passes.
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton: finds every phrase in one pass over the text,
+    however many phrases there are.
+    """
+
+    def __init__(self, phrases):
+        # phrases: {phrase: label}
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [set()]
+        for phrase, label in phrases.items():
+            state = 0
+            for ch in phrase:
+                if ch not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(set())
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            self.out[state].add(label)
+
+        # Breadth-first: a state's failure link is the longest proper suffix
+        # that is also a prefix of some phrase
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] |= self.out[self.fail[nxt]]
+
+    def labels(self, text):
+        """Set of labels whose phrases occur in text."""
+        found = set()
+        state = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+_matcher = KeywordMatcher({p: name for name, (_, phrases) in SIGNALS.items() for p in phrases})
+
+
+# ================= TEXT ================= #
+
+def text_score(text):
+    return sum(SIGNALS[name][0] for name in _matcher.labels((text or "").lower()))
+
+
+def looks_like_po(text, min_score=MIN_PO_SCORE):
+    """
+    Semantic, wording-independent PO detection
+    """
+    return text_score(text) >= min_score
+
+
+# ================= ATTACHMENTS ================= #
+
+def screen_part(filename, size, content_id=None):
+    """
+    Before download, from BODYSTRUCTURE alone. size is the transfer-encoded
+    size. Returns the reason to skip the part, or None to fetch it; the
+    dimension probe in screen_file() decides the rest.
+    """
+    name = os.path.basename(filename or "")
+    if PO_NAME_RE.search(name) or not name.lower().endswith(IMAGE_EXT):
+        return None
+    if BRANDING_NAME_RE.search(name):
+        return f"file name {name!r}"
+    if content_id and DEFAULT_IMAGE_NAME_RE.search(name):
+        return f"inline image {name!r}"
+    # base64 is 4/3 of the decoded size
+    if size and size * 3 // 4 < IMAGE_MIN_BYTES:
+        return f"image of {size * 3 // 4} bytes"
+    return None
+
+
+def _image_size(path):
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        with Image.open(path) as img:      # reads the header only
+            return img.size
+    except Exception:
+        return None
+
+
+def _pdf_text(path):
+    try:
+        with pdfplumber.open(path) as pdf:
+            return "\n".join((p.extract_text() or "") for p in pdf.pages[:PDF_PROBE_PAGES])
+    except Exception:
+        return None
+
+
+def _docx_text(path):
+    try:
+        with zipfile.ZipFile(path) as z:
+            xml = z.read("word/document.xml").decode("utf-8", errors="ignore")
+    except (KeyError, OSError, zipfile.BadZipFile):
+        return None
+    # Paragraph ends become spaces so words don't run together
+    return re.sub(r"<[^>]+>", "", xml.replace("</w:p>", " "))
+
+
+def screen_file(path, filename=None):
+    """
+    After download, from the file itself. Returns the reason it is not a
+    PO, or None to queue it for OCR.
+    """
+    if PO_NAME_RE.search(os.path.basename(filename or path)):
+        return None
+    ext = os.path.splitext(path)[1].lower()
+
+    if ext in IMAGE_EXT:
+        size = _image_size(path)
+        if size and min(size) < IMAGE_MIN_SIDE:
+            return f"image of {size[0]}x{size[1]} px"
+        return None
+
+    if ext == ".pdf":
+        text = _pdf_text(path)
+    elif ext == ".docx":
+        text = _docx_text(path)
+    else:
+        return None
+
+    if text is None or len(text.strip()) < PROBE_MIN_CHARS:
+        return None
+    score = text_score(text)
+    if score < MIN_PO_SCORE:
+        return f"text scores {score} < {MIN_PO_SCORE}"
+    return None
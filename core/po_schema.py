@@ -0,0 +1,156 @@
+import re
+import json
+
+from core.po_templates import parse_date
+
+
+# ================= CANONICAL PO SCHEMA ================= #
+
+# Single source for the extraction output: the Ollama `format` JSON schema,
+# the example structure in the prompt and normalize() are all derived from
+# this. A dict is an object, a one-element list is an array of that shape.
+
+TEXT = "text"
+NUMBER = "number"     # float, or None when missing
+DATE = "date"         # ISO yyyy-mm-dd, or "" when missing
+
+PO_SCHEMA = {
+    "po_number": TEXT,
+    "po_date": DATE,
+    "buyer": {
+        "company_name": TEXT,
+        "gst_number": TEXT,
+        "address": TEXT,
+        "email": TEXT
+    },
+    "seller": {
+        "company_name": TEXT,
+        "gst_number": TEXT,
+        "address": TEXT
+    },
+    "currency": TEXT,
+    "total_amount": NUMBER,
+    "line_items": [
+        {
+            "product_id": TEXT,
+            "product_identifier_raw": TEXT,
+            "product_identifier_type": TEXT,
+            "description": TEXT,
+            "unit": TEXT,
+            "quantity": NUMBER,
+            "unit_price": NUMBER,
+            "line_total": NUMBER
+        }
+    ]
+}
+
+# Chunked extraction (large POs): header fields once, line items per chunk
+HEADER_SCHEMA = {k: v for k, v in PO_SCHEMA.items() if k != "line_items"}
+ITEMS_SCHEMA = {"line_items": PO_SCHEMA["line_items"]}
+
+# ========================================= #
+
+# Currency words/symbols and Indian "/-" suffixes around amounts
+_NUMBER_NOISE_RE = re.compile(r"(?i)\b(inr|usd|eur|gbp|rs)\b\.?|[₹$€£,\s]|/-$")
+_NUMBER_RE = re.compile(r"^-?\d+(\.\d+)?$")
+
+
+def json_schema(spec=PO_SCHEMA):
+    """JSON schema for Ollama's `format` option."""
+    if isinstance(spec, dict):
+        return {
+            "type": "object",
+            "properties": {k: json_schema(v) for k, v in spec.items()},
+            "required": list(spec),
+            "additionalProperties": False
+        }
+    if isinstance(spec, list):
+        return {"type": "array", "items": json_schema(spec[0])}
+    if spec == NUMBER:
+        return {"type": ["number", "null"]}
+    return {"type": "string"}
+
+
+def skeleton(spec=PO_SCHEMA):
+    """Empty instance of the schema, as shown to the model in the prompt."""
+    if isinstance(spec, dict):
+        return {k: skeleton(v) for k, v in spec.items()}
+    if isinstance(spec, list):
+        return [skeleton(spec[0])]
+    return None if spec == NUMBER else ""
+
+
+def prompt_structure(spec=PO_SCHEMA):
+    return json.dumps(skeleton(spec), indent=2)
+
+
+def to_number(val):
+    """'1,23,456.50', 'Rs. 500/-', '₹ 1 200', '(300)' -> float; None if not a number."""
+    if val is None or isinstance(val, bool):
+        return None
+    if isinstance(val, (int, float)):
+        return float(val)
+    s = str(val).strip()
+    negative = s.startswith("(") and s.endswith(")")
+    s = _NUMBER_NOISE_RE.sub("", s.strip("()"))
+    if not _NUMBER_RE.match(s):
+        return None
+    n = float(s)
+    return -n if negative else n
+
+
+def _is_empty(val):
+    return val is None or val == "" or val == [] or val == {} or (
+        isinstance(val, dict) and all(_is_empty(v) for v in val.values())
+    )
+
+
+def _normalize(val, spec, path, issues):
+    if isinstance(spec, dict):
+        if not isinstance(val, dict):
+            if val not in (None, ""):
+                issues.append(f"{path or 'root'}: expected object")
+            val = {}
+        return {k: _normalize(val.get(k), s, f"{path}.{k}" if path else k, issues) for k, s in spec.items()}
+
+    if isinstance(spec, list):
+        if isinstance(val, dict):
+            val = [val]
+        if not isinstance(val, list):
+            if val not in (None, ""):
+                issues.append(f"{path}: expected array")
+            return []
+        out = [_normalize(v, spec[0], f"{path}[{i}]", issues) for i, v in enumerate(val)]
+        return [v for v in out if not _is_empty(v)]
+
+    if spec == NUMBER:
+        n = to_number(val)
+        if n is None and val not in (None, ""):
+            issues.append(f"{path}: not a number: {val!r}")
+        return n
+
+    if isinstance(val, (dict, list)):
+        issues.append(f"{path}: expected a string")
+        return ""
+    text = "" if val is None else " ".join(str(val).split())
+
+    if spec == DATE and text:
+        d = parse_date(text)
+        if d is None:
+            issues.append(f"{path}: not a date: {text!r}")
+            return ""
+        return d.isoformat()
+    return text
+
+
+def normalize(data, spec=PO_SCHEMA):
+    """
+    Validate and coerce extracted data against the schema in one pass:
+    missing fields are filled, unknown ones dropped, amounts parsed to
+    floats and dates to ISO. Returns (data, issues); issues lists the
+    values that had to be dropped.
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"extraction is not a JSON object: {type(data).__name__}")
+    issues = []
+    return _normalize(data, spec, "", issues), issues
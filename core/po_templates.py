@@ -0,0 +1,464 @@
+import os
+import re
+import json
+import hashlib
+from datetime import datetime
+
+from dateutil import parser as date_parser
+
+
+# ================= CONFIG ================= #
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TEMPLATE_DIR = os.getenv("PO_TEMPLATE_DIR", os.path.join(BASE_DIR, "po_templates"))
+ENABLE_TEMPLATES = os.getenv("PO_TEMPLATES", "1") == "1"
+
+KEYWORD_LINES = 15            # header lines used for the layout fingerprint
+MIN_KEYWORD_SIMILARITY = 0.6  # Jaccard overlap to accept a known layout
+AMOUNT_TOLERANCE = 0.01       # 1% for qty x price and total cross-checks
+
+# ========================================= #
+
+os.makedirs(TEMPLATE_DIR, exist_ok=True)
+
+# A template is learned from a PO the LLM extracted successfully, and only
+# if re-applying the learned rules to that same document reproduces the
+# LLM's answer. It stores:
+#   - the buyer (customer) GSTIN and header keywords (the layout fingerprint)
+#   - label regexes for po_number / po_date / total_amount
+#   - the line item table header and which column holds which field
+#   - constant blocks (buyer, seller, currency) that never change per layout
+# Applying a template costs a few regex searches instead of an LLM call.
+
+GSTIN_RE = re.compile(r"\b\d{2}[A-Z]{5}\d{4}[A-Z][1-9A-Z]Z[0-9A-Z]\b")
+NUMBER_RE = re.compile(r"\d[\d,]*(?:\.\d+)?")
+DATE_PATTERN = (
+    r"\d{1,4}[./-]\d{1,2}[./-]\d{1,4}"
+    r"|\d{1,2}[\s-](?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*[\s,-]+\d{2,4}"
+)
+DATE_RE = re.compile(DATE_PATTERN, re.IGNORECASE)
+LABEL_RE = re.compile(r"([A-Za-z][A-Za-z .#/&()]{1,30}?)\s*[:#.\-]?\s*$")
+
+SCALAR_FIELDS = ("po_number", "po_date", "total_amount")
+ITEM_FIELDS = (
+    "product_id", "product_identifier_raw", "description",
+    "unit", "quantity", "unit_price", "line_total"
+)
+NUMERIC_FIELDS = ("quantity", "unit_price", "line_total", "total_amount")
+
+
+# ================= HELPERS ================= #
+
+def to_number(val):
+    try:
+        return float(str(val).replace(",", "").replace("INR", "").replace("$", "").strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_date(val, dayfirst=True):
+    s = str(val).strip()
+    if re.match(r"\d{4}[./-]", s):
+        dayfirst = False    # ISO-style, year first: dayfirst would swap month/day
+    try:
+        return date_parser.parse(s, dayfirst=dayfirst).date()
+    except (ValueError, OverflowError, TypeError):
+        return None
+
+
+def norm(s):
+    return " ".join(str(s or "").lower().split())
+
+
+def shape_pattern(raw):
+    """Generalize a literal like 'PO-2026-1003' into [A-Za-z]+\\-\\d+\\-\\d+."""
+    out = []
+    for m in re.finditer(r"\d+|[A-Za-z]+|.", raw):
+        tok = m.group()
+        if tok.isdigit():
+            out.append(r"\d+")
+        elif tok.isalpha():
+            out.append(r"[A-Za-z]+")
+        else:
+            out.append(re.escape(tok))
+    return "".join(out)
+
+
+def header_keywords(text):
+    words = set()
+    for line in text.splitlines()[:KEYWORD_LINES]:
+        words.update(w.lower() for w in re.findall(r"[A-Za-z]{3,}", line))
+    return words
+
+
+def jaccard(a, b):
+    a, b = set(a), set(b)
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+def document_text(pages):
+    return "\n".join(p.get("text", "") for p in pages)
+
+
+def document_tables(pages):
+    return [t for p in pages for t in p.get("tables", [])]
+
+
+# ================= STORAGE ================= #
+
+def _template_path(template_id):
+    return os.path.join(TEMPLATE_DIR, f"{template_id}.json")
+
+
+def load_templates():
+    templates = []
+    for name in os.listdir(TEMPLATE_DIR):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(TEMPLATE_DIR, name)) as f:
+                templates.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return templates
+
+
+def save_template(template):
+    path = _template_path(template["id"])
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(template, f, indent=2)
+    os.replace(tmp, path)
+
+
+# ================= RULES ================= #
+
+def _value_spans(text, field, value, dayfirst=True):
+    if field == "total_amount":
+        target = to_number(value)
+        if target is None:
+            return
+        for m in NUMBER_RE.finditer(text):
+            n = to_number(m.group())
+            if n is not None and abs(n - target) < 0.005:
+                yield m.span()
+    elif field == "po_date":
+        target = parse_date(value)
+        if target is None:
+            return
+        for m in DATE_RE.finditer(text):
+            if parse_date(m.group(), dayfirst) == target:
+                yield m.span()
+    else:
+        value = str(value).strip()
+        if value:
+            for m in re.finditer(re.escape(value), text):
+                yield m.span()
+
+
+def _learn_scalar(text, field, value):
+    """
+    Build a label regex for a header field, e.g. 'PO\\ No\\s*[:#.\\-]?\\s*([A-Za-z]+\\-\\d+)'.
+    Returns the rule dict or None if the value has no usable label.
+    """
+    for dayfirst in (True, False):
+        for start, end in _value_spans(text, field, value, dayfirst):
+            line_start = text.rfind("\n", 0, start) + 1
+            m = LABEL_RE.search(text[line_start:start])
+            if not m:
+                continue
+            label = m.group(1).strip()
+            if field == "total_amount":
+                value_pattern = r"\d[\d,]*(?:\.\d+)?"
+            elif field == "po_date":
+                value_pattern = DATE_PATTERN
+            else:
+                value_pattern = shape_pattern(text[start:end])
+
+            pattern = re.escape(label) + r"\s*[:#.\-]?\s*(" + value_pattern + ")"
+            return {"pattern": pattern, "dayfirst": dayfirst}
+        if field != "po_date":
+            break
+    return None
+
+
+def _apply_scalar(text, field, rule):
+    m = re.search(rule["pattern"], text, re.IGNORECASE)
+    if not m:
+        return None
+    raw = m.group(1)
+    if field == "total_amount":
+        return raw.replace(",", "")
+    if field == "po_date":
+        d = parse_date(raw, rule.get("dayfirst", True))
+        return d.isoformat() if d else None
+    return raw
+
+
+def _cell_matches(cell, value, field):
+    if field in NUMERIC_FIELDS:
+        a, b = to_number(cell), to_number(value)
+        return a is not None and b is not None and abs(a - b) < 0.005
+    return bool(norm(value)) and norm(value) in norm(cell)
+
+
+def _learn_table(tables, items):
+    """
+    Find the table holding the LLM's line items and map each item field to
+    a header label. Returns {"header": [...], "columns": {field: label}}.
+    """
+    for table in tables:
+        header = [norm(h) for h in table[0]]
+        rows = table[1:]
+        if len(set(header)) != len(header) or not all(header):
+            continue    # need unique, non-empty labels to address columns
+
+        columns = {}
+        for field in ITEM_FIELDS:
+            values = [it.get(field) for it in items]
+            if not any(str(v or "").strip() for v in values):
+                continue
+            for j, label in enumerate(header):
+                cells = [r[j] for r in rows]
+                # every non-empty value must appear, in order, in this column
+                pos = 0
+                ok = True
+                for v in values:
+                    if not str(v or "").strip():
+                        continue
+                    while pos < len(cells) and not _cell_matches(cells[pos], v, field):
+                        pos += 1
+                    if pos == len(cells):
+                        ok = False
+                        break
+                    pos += 1
+                if ok:
+                    columns[field] = label
+                    break
+
+        if "description" in columns and "quantity" in columns:
+            return {"header": header, "columns": columns}
+    return None
+
+
+def _apply_table(tables, rule, constants):
+    items = []
+    for table in tables:
+        header = [norm(h) for h in table[0]]
+        if not all(label in header for label in rule["columns"].values()):
+            continue
+        idx = {f: header.index(label) for f, label in rule["columns"].items()}
+        for row in table[1:]:
+            qty = to_number(row[idx["quantity"]])
+            desc = row[idx["description"]].strip()
+            if qty is None or not desc:
+                continue    # subtotal / tax / blank rows
+            item = {f: "" for f in ITEM_FIELDS}
+            item.update(constants)
+            for f, j in idx.items():
+                cell = row[j].strip()
+                item[f] = cell.replace(",", "") if f in NUMERIC_FIELDS else cell
+            items.append(item)
+    return items
+
+
+# ================= CONFIDENCE ================= #
+
+def _checks(data, template, text):
+    """Cross-checks a template result must pass. Returns {name: bool}."""
+    checks = {}
+    for field in SCALAR_FIELDS:
+        if field in template["scalars"]:
+            checks[field] = bool(data.get(field))
+
+    items = data.get("line_items", [])
+    checks["line_items"] = bool(items)
+
+    for i, it in enumerate(items):
+        q, p, t = to_number(it.get("quantity")), to_number(it.get("unit_price")), to_number(it.get("line_total"))
+        if None not in (q, p, t):
+            checks[f"item{i}_qty_x_price"] = abs(q * p - t) <= max(AMOUNT_TOLERANCE * t, 0.01)
+
+    ratio = template.get("total_ratio")
+    total = to_number(data.get("total_amount"))
+    line_sum = sum(to_number(it.get("line_total")) or 0 for it in items)
+    if ratio and total and line_sum:
+        checks["total_matches_items"] = abs(total / line_sum - ratio) <= AMOUNT_TOLERANCE * ratio
+
+    # Constant parties must actually be on this document: one layout
+    # serves several buyers, and a buyer without a GSTIN must not inherit
+    # another customer's name and address
+    for party in ("buyer", "seller"):
+        constant = template["constants"].get(party, {})
+        gst = constant.get("gst_number")
+        if gst:
+            checks[f"{party}_gst_present"] = gst in text
+        name = norm(constant.get("company_name"))
+        if name:
+            checks[f"{party}_name_present"] = name in norm(text)
+    return checks
+
+
+# ================= PUBLIC API ================= #
+
+def fingerprint(text):
+    return set(GSTIN_RE.findall(text)), header_keywords(text)
+
+
+def match_template(text, templates=None):
+    gstins, keywords = fingerprint(text)
+    best, best_score = None, 0.0
+    for t in templates if templates is not None else load_templates():
+        if "buyer_gst" not in t:
+            continue    # learned before buyer fingerprints; relearned on the next LLM run
+        if t["buyer_gst"] and t["buyer_gst"] not in gstins:
+            continue
+        score = jaccard(keywords, t["keywords"])
+        if score >= MIN_KEYWORD_SIMILARITY and score > best_score:
+            best, best_score = t, score
+    return best
+
+
+def apply_template(template, pages):
+    """
+    Extract a PO with a template's compiled rules.
+    Returns (data, confidence, checks); data is None if a rule didn't match.
+    """
+    text = document_text(pages)
+    data = json.loads(json.dumps(template["constants"]))    # deep copy
+
+    for field, rule in template["scalars"].items():
+        value = _apply_scalar(text, field, rule)
+        if value is None:
+            return None, 0.0, {field: False}
+        data[field] = value
+
+    data["line_items"] = _apply_table(
+        document_tables(pages), template["table"], template.get("item_constants", {})
+    )
+
+    checks = _checks(data, template, text)
+    confidence = sum(checks.values()) / len(checks) if checks else 0.0
+    return data, confidence, checks
+
+
+def try_extract(pages, min_confidence=1.0):
+    """
+    Fast path for known layouts. Returns (data, template_id) or (None, None)
+    when the layout is unknown or any cross-check fails.
+    """
+    if not ENABLE_TEMPLATES:
+        return None, None
+
+    template = match_template(document_text(pages))
+    if not template:
+        return None, None
+
+    data, confidence, checks = apply_template(template, pages)
+    if data is None or confidence < min_confidence:
+        failed = [k for k, ok in checks.items() if not ok]
+        print(f"🧩 Template {template['id']} matched but failed checks {failed}. Using LLM.")
+        return None, None
+
+    template["hits"] = template.get("hits", 0) + 1
+    template["last_used"] = datetime.now().isoformat(timespec="seconds")
+    save_template(template)
+    return data, template["id"]
+
+
+def _same_result(a, b):
+    for field in SCALAR_FIELDS:
+        if field == "total_amount":
+            if to_number(a.get(field)) != to_number(b.get(field)):
+                return False
+        elif field == "po_date":
+            if parse_date(a.get(field)) != parse_date(b.get(field)):
+                return False
+        elif norm(a.get(field)) != norm(b.get(field)):
+            return False
+
+    ia, ib = a.get("line_items", []), b.get("line_items", [])
+    if len(ia) != len(ib):
+        return False
+    for x, y in zip(ia, ib):
+        if norm(x.get("description")) != norm(y.get("description")):
+            return False
+        for f in ("quantity", "unit_price", "line_total"):
+            if to_number(x.get(f)) != to_number(y.get(f)):
+                return False
+    return True
+
+
+def learn(pages, extracted):
+    """
+    Learn a template from a successful LLM extraction. Saved only if the
+    learned rules reproduce the LLM result on this same document.
+    Returns the template id or None.
+    """
+    if not ENABLE_TEMPLATES:
+        return None
+
+    text = document_text(pages)
+    tables = document_tables(pages)
+    items = extracted.get("line_items") or []
+    if not tables or not items:
+        return None
+
+    # The customer's GSTIN tells layouts apart; the seller is us on every
+    # inbound PO
+    buyer_gst = (extracted.get("buyer") or {}).get("gst_number", "").strip()
+    if buyer_gst and buyer_gst not in text:
+        return None
+
+    scalars = {}
+    for field in SCALAR_FIELDS:
+        if not extracted.get(field):
+            continue
+        rule = _learn_scalar(text, field, extracted[field])
+        if rule is None:
+            return None
+        scalars[field] = rule
+
+    table = _learn_table(tables, items)
+    if table is None:
+        return None
+
+    # Item fields not in any column but identical on every item
+    item_constants = {}
+    for field in ITEM_FIELDS + ("product_identifier_type",):
+        if field in table["columns"]:
+            continue
+        values = {str(it.get(field, "")) for it in items}
+        if len(values) == 1:
+            item_constants[field] = values.pop()
+
+    keywords = header_keywords(text)
+    template = {
+        "id": hashlib.sha1((buyer_gst + "|" + " ".join(sorted(keywords))).encode()).hexdigest()[:12],
+        "buyer_gst": buyer_gst,
+        "keywords": sorted(keywords),
+        "scalars": scalars,
+        "table": table,
+        "constants": {
+            "buyer": extracted.get("buyer", {}),
+            "seller": extracted.get("seller", {}),
+            "currency": extracted.get("currency", ""),
+        },
+        "item_constants": item_constants,
+        "hits": 0,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+    total = to_number(extracted.get("total_amount"))
+    line_sum = sum(to_number(it.get("line_total")) or 0 for it in items)
+    if total and line_sum:
+        template["total_ratio"] = total / line_sum
+
+    data, confidence, _ = apply_template(template, pages)
+    if data is None or confidence < 1.0 or not _same_result(data, extracted):
+        return None
+
+    save_template(template)
+    print(f"🧩 Learned PO template {template['id']} (buyer GST {buyer_gst or 'n/a'})")
+    return template["id"]
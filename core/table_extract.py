@@ -0,0 +1,249 @@
+import os
+
+
+# ================= CONFIG ================= #
+
+# Free-text budget, shared by the pages that have tables: their items are
+# already in the tables, so only header/footer text is trimmed. Tables and
+# pages without a detected table (items as plain lines) are never cut.
+LLM_TEXT_BUDGET = int(os.getenv("LLM_TEXT_BUDGET", "3000"))
+
+MIN_TABLE_COLS = 3        # an OCR row needs this many cells to count as tabular
+MIN_TABLE_ROWS = 2        # header + at least one item
+
+# ========================================= #
+
+
+def clean_cell(cell):
+    return " ".join(str(cell).split()) if cell is not None else ""
+
+
+def clean_table(rows):
+    """Normalize whitespace, drop empty rows and columns, pad ragged rows."""
+    rows = [[clean_cell(c) for c in r] for r in rows if r]
+    rows = [r for r in rows if any(r)]
+    if not rows:
+        return []
+    ncols = max(len(r) for r in rows)
+    rows = [r + [""] * (ncols - len(r)) for r in rows]
+    keep = [j for j in range(ncols) if any(r[j] for r in rows)]
+    return [[r[j] for j in keep] for r in rows]
+
+
+# ================= DIGITAL PAGES ================= #
+
+def digital_page_tables(page):
+    """
+    Tables on a pdfplumber page via its ruling-line/alignment detection.
+    Returns (text_outside_tables, tables). text is None when there are no
+    tables (the caller keeps the full page text).
+    """
+    try:
+        found = page.find_tables()
+    except Exception:
+        return None, []
+
+    tables = []
+    outside = page
+    for t in found:
+        rows = clean_table(t.extract())
+        if len(rows) < MIN_TABLE_ROWS:
+            continue
+        tables.append(rows)
+        try:
+            outside = outside.outside_bbox(t.bbox)
+        except Exception:
+            pass
+
+    if not tables:
+        return None, []
+    try:
+        text = outside.extract_text() or ""
+    except Exception:
+        text = None
+    return text, tables
+
+
+# ================= SCANNED PAGES ================= #
+
+def group_rows(lines):
+    """
+    Group PaddleOCR boxes into visual rows.
+    lines: [(box, text, score)] with box = 4 [x, y] points.
+    Returns rows of cells sorted left to right; each cell is a dict
+    {"x0", "x1", "text", "score"}.
+    """
+    items = []
+    for box, text, score in lines:
+        xs = [p[0] for p in box]
+        ys = [p[1] for p in box]
+        items.append({
+            "y0": min(ys), "y1": max(ys),
+            "x0": min(xs), "x1": max(xs),
+            "text": text, "score": score
+        })
+    if not items:
+        return []
+
+    heights = sorted(i["y1"] - i["y0"] for i in items)
+    tol = max(heights[len(heights) // 2] * 0.5, 1)
+
+    items.sort(key=lambda i: (i["y0"] + i["y1"]) / 2)
+    rows = []
+    current = []
+    center = 0
+    for it in items:
+        c = (it["y0"] + it["y1"]) / 2
+        if current and abs(c - center) > tol:
+            rows.append(current)
+            current = []
+        current.append(it)
+        center = sum((i["y0"] + i["y1"]) / 2 for i in current) / len(current)
+    rows.append(current)
+
+    return [sorted(r, key=lambda i: i["x0"]) for r in rows]
+
+
+def align_columns(run):
+    """
+    Snap the cells of consecutive tabular rows onto the columns of the
+    widest row (usually the header).
+    """
+    header = max(run, key=len)
+    anchors = [(c["x0"] + c["x1"]) / 2 for c in header]
+
+    table = []
+    for row in run:
+        cells = [""] * len(anchors)
+        for c in row:
+            mid = (c["x0"] + c["x1"]) / 2
+            j = min(range(len(anchors)), key=lambda k: abs(anchors[k] - mid))
+            cells[j] = (cells[j] + " " + c["text"]).strip()
+        table.append(cells)
+    return clean_table(table)
+
+
+def ocr_page_layout(lines):
+    """
+    Rebuild line text and tables from OCR boxes.
+    Returns (text, text_outside_tables, tables).
+    """
+    rows = group_rows(lines)
+
+    tables = []
+    outside = []
+    run = []
+    for row in rows + [[]]:
+        if len(row) >= MIN_TABLE_COLS:
+            run.append(row)
+            continue
+        if len(run) >= MIN_TABLE_ROWS:
+            tables.append(align_columns(run))
+        else:
+            outside.extend(run)
+        run = []
+        if row:
+            outside.append(row)
+
+    def join(rs):
+        return "\n".join(" ".join(c["text"] for c in r) for r in rs)
+
+    return join(rows), join(sorted(outside, key=lambda r: r[0]["y0"])), tables
+
+
+# ================= LLM INPUT ================= #
+
+def format_table(rows):
+    return "\n".join(" | ".join(r) for r in rows)
+
+
+def build_llm_input(pages, text_budget=LLM_TEXT_BUDGET):
+    """
+    Compact document for the LLM, in page order: the free text of each page
+    followed by its tables as "a | b | c" rows. Free text of pages with
+    tables shares text_budget (None: no limit); other pages are sent whole.
+    Whitespace runs from OCR/pdfplumber are collapsed.
+    """
+    parts = []
+    remaining = text_budget
+    for p in pages:
+        body = p.get("body")
+        if body is None:
+            body = p.get("text", "")
+        body = "\n".join(" ".join(line.split()) for line in body.splitlines() if line.strip())
+
+        if body and (remaining is None or not p.get("tables")):
+            parts.append(body)
+        elif body and remaining > 0:
+            parts.append(body[:remaining])
+            remaining -= len(parts[-1])
+
+        for i, table in enumerate(p.get("tables", []), start=1):
+            parts.append(f"[TABLE p{p['page']}.{i}]\n{format_table(table)}")
+
+    return "\n\n".join(parts)
+
+
+def split_llm_chunks(pages, max_chars):
+    """
+    Split a long document into LLM inputs of about max_chars for line item
+    extraction. Whole pages are grouped while they fit; a page without
+    tables that is too large is cut between lines; a table too large
+    for one chunk is cut between rows, with its header row repeated so
+    every piece keeps its column names. The text around such a table only
+    rides along in a chunk with room for it: on its own it holds no items
+    (the header call reads it) and would cost a po_items call.
+    """
+    pieces = []
+    for p in pages:
+        page_input = build_llm_input([p], text_budget=max_chars)
+        if len(page_input) <= max_chars:
+            pieces.append((page_input, False))
+            continue
+
+        body = build_llm_input([dict(p, tables=[])], text_budget=None)
+        if not p.get("tables"):
+            # No table detected: the items are plain lines, cut between them
+            part, size = [], 0
+            for line in body.splitlines():
+                if part and size + len(line) > max_chars:
+                    pieces.append(("\n".join(part), False))
+                    part, size = [], 0
+                part.append(line)
+                size += len(line) + 1
+            if part:
+                pieces.append(("\n".join(part), False))
+            continue
+        if body:
+            pieces.append((body[:max_chars], True))
+        for i, table in enumerate(p.get("tables", []), start=1):
+            header, rows = table[0], table[1:]
+            label = f"[TABLE p{p['page']}.{i}]"
+            part = []
+            size = 0
+            for row in rows:
+                line = " | ".join(row)
+                if part and size + len(line) > max_chars:
+                    pieces.append((f"{label}\n{format_table([header] + part)}", False))
+                    part, size = [], 0
+                part.append(row)
+                size += len(line) + 1
+            if part:
+                pieces.append((f"{label}\n{format_table([header] + part)}", False))
+
+    chunks = []
+    body = None       # body-only text waiting for a chunk with room
+    for piece, body_only in pieces:
+        if not piece:
+            continue
+        if chunks and len(chunks[-1]) + len(piece) + 2 <= max_chars:
+            chunks[-1] += "\n\n" + piece
+            continue
+        if body_only:
+            body = piece
+            continue
+        if body and len(body) + len(piece) + 2 <= max_chars:
+            piece = body + "\n\n" + piece
+        body = None
+        chunks.append(piece)
+    return chunks
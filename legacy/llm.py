@@ -1,17 +1,14 @@
-import requests
+import os
+import sys
+
+# Add project root to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import llm_client
 
 def llama(prompt):
     try:
-        res = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": "qwen2.5:7b",
-                "prompt": prompt,
-                "stream": False
-            },
-            timeout=60
-        )
-        return res.json().get("response", "").strip()
+        return llm_client.generate(prompt, timeout=60, tag="legacy").strip()
     except Exception as e:
         print("🔥 LLM Error:", e)
         return "Error"
@@ -63,20 +63,21 @@ def check_db_for_po():
         print(f"DB Check Error: {e}")
         return None
 
-def check_manifest():
-    manifest_path = "manifest.json"
-    if not os.path.exists(manifest_path):
-        return None
+def check_queue():
+    from core import job_queue
+    conn = job_queue.get_connection()
     try:
-        with open(manifest_path, "r") as f:
-            data = json.load(f)
-            # Find the entry that corresponds to our test file
-            for fname, meta in data.items():
-                if meta.get("email_metadata", {}).get("subject") == f"New Purchase Order: {PO_NUMBER}" or \
-                   meta.get("email_metadata", {}).get("from_email") == EMAIL_USER:
-                    return meta
+        rows = conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT 20").fetchall()
+        # Find the entry that corresponds to our test file
+        for row in rows:
+            meta = json.loads(row["email_metadata"] or "{}")
+            if meta.get("subject") == f"New Purchase Order: {PO_NUMBER}" or \
+               meta.get("from_email") == EMAIL_USER:
+                return dict(row)
     except:
         pass
+    finally:
+        conn.close()
     return None
 
 def run_test():
@@ -94,11 +95,11 @@ def run_test():
     }
     
     while time.time() - start_time < timeout:
-        # Check Stage 1: Ingestion (via manifest or incoming folder)
+        # Check Stage 1: Ingestion (via job queue)
         if not stages["ingestion"]:
-            manifest = check_manifest()
-            if manifest:
-                print("🔹 [STAGE 1] Ingestion: SUCCESS (Found in manifest)")
+            job = check_queue()
+            if job:
+                print(f"🔹 [STAGE 1] Ingestion: SUCCESS (Found in job queue, status: {job['status']})")
                 stages["ingestion"] = True
                 
         # Check Stage 2 & 3: OCR and DB
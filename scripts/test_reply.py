@@ -1,5 +1,6 @@
 
 from reply_listener import classify_intent
+from core.intent_classifier import LEXICON_CASES, lexicon_match, normalize
 
 test_cases = [
     "Yes, please ship whatever you have.",
@@ -16,3 +17,12 @@ print("--- Testing LLM Intent Classification ---")
 for text in test_cases:
     intent = classify_intent(text)
     print(f"'{text}' \n   -> {intent}\n")
+
+print("--- Lexicon regressions (no LLM) ---")
+failed = 0
+for text, expected in LEXICON_CASES.items():
+    got = lexicon_match(normalize(text))
+    if got != expected:
+        failed += 1
+        print(f"FAIL '{text}' -> {got} (expected {expected})")
+print(f"{len(LEXICON_CASES) - failed}/{len(LEXICON_CASES)} lexicon cases pass")
@@ -1,10 +1,13 @@
 import imaplib
-import email
-from email.header import decode_header
+import re
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+from collections import defaultdict
 import os
-import json
 import uuid
+import hashlib
 import time
+import sys
 from datetime import datetime
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
@@ -13,27 +16,44 @@ from dotenv import load_dotenv
 # Load local environment variables
 load_dotenv()
 
+# Add project root to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core import job_queue
+from core import mail_sync
+from core.po_prefilter import looks_like_po, screen_part, screen_file
+from core.imap_client import (
+    MailboxConnection, PartDecoder, IMAP_PART_CHUNK, parse_fetch, walk_bodystructure, decode_part, iter_part
+)
+
 # ================== CONFIG ================== #
 
-IMAP_SERVER = "imap.gmail.com"
+IMAP_SERVER = os.getenv("IMAP_SERVER", "imap.gmail.com")
+IMAP_MAILBOX = "INBOX"
 EMAIL_USER = os.getenv("EMAIL_USER")
 EMAIL_PASS = os.getenv("EMAIL_PASS")
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 INCOMING = os.path.join(BASE_DIR, "incoming")
 LOGS = os.path.join(BASE_DIR, "logs")
-MANIFEST = os.path.join(BASE_DIR, "manifest.json")
+# Attachments the pre-filter decided are not POs, kept for inspection
+REJECTED = os.path.join(BASE_DIR, "rejected")
 
 ALLOWED_EXT = (".pdf", ".docx", ".jpg", ".jpeg", ".png")
 
-INITIAL_POLL = 5          # seconds
-MAX_POLL = 1800           # 30 minutes
-MIN_PO_SCORE = 3          # semantic threshold
+# Sync cursor name in jobs.db (see core/mail_sync.py)
+SYNC_CONSUMER = "router"
+REPLY_SUBJECT_RE = re.compile(r"^\s*(re|aw|sv)\s*:", re.IGNORECASE)
+
+ERROR_BACKOFF = 5         # seconds, after an unexpected error
+FETCH_BATCH = 50          # messages per UID FETCH / STORE
+FETCH_MAX_BYTES = 8 * 1024 * 1024     # small-part bytes per UID FETCH
 
 # ============================================ #
 
 os.makedirs(INCOMING, exist_ok=True)
 os.makedirs(LOGS, exist_ok=True)
+os.makedirs(REJECTED, exist_ok=True)
 
 
 # ================== LOGGING ================== #
@@ -46,36 +66,6 @@ def log(msg):
         f.write(line + "\n")
 
 
-# ================== MANIFEST ================== #
-
-def load_manifest():
-    try:
-        with open(MANIFEST) as f:
-            return json.load(f)
-    except:
-        return {}
-
-def save_manifest(m):
-    with open(MANIFEST, "w") as f:
-        json.dump(m, f, indent=2)
-
-
-# ================== PO DETECTION ================== #
-
-def looks_like_po(text):
-    """
-    Semantic, wording-independent PO detection
-    """
-    signals = [
-        "bill to", "supplier", "vendor", "total",
-        "amount", "price", "quantity", "gst",
-        "item", "service"
-    ]
-    text = text.lower()
-    score = sum(1 for s in signals if s in text)
-    return score >= MIN_PO_SCORE
-
-
 # ================== EMAIL BODY → PDF ================== #
 
 def email_body_to_pdf(text, output_path):
@@ -93,127 +83,329 @@ def email_body_to_pdf(text, output_path):
 
 # ================== EMAIL POLLING ================== #
 
-def poll_emails(poll_interval):
-    mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-    mail.login(EMAIL_USER, EMAIL_PASS)
-    mail.select("INBOX")
+def new_file_name(suffix):
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    uid = uuid.uuid4().hex[:8]
+    return f"{ts}_{uid}{suffix}"
 
-    status, msgs = mail.search(None, "UNSEEN")
-    ids = msgs[0].split()
 
-    if not ids:
-        mail.logout()
-        # Return False but keep the same polling speed (User Requirement)
-        return False, INITIAL_POLL
+def attachment_name(part):
+    name = part["filename"]
+    if not name:
+        return None
+    name = decode_header(name)[0][0]
+    if isinstance(name, bytes):
+        name = name.decode(errors="ignore")
+    return name
 
-    mail_id = ids[-1]
-    _, data = mail.fetch(mail_id, "(RFC822)")
 
-    for resp in data:
-        if not isinstance(resp, tuple):
+def plan_message(fields):
+    """
+    From a message's BODYSTRUCTURE, the parts worth downloading: allowed
+    attachments that pass the name/size pre-filter, and the plain-text
+    body (small, and the fallback if every attachment is rejected).
+    """
+    parts = walk_bodystructure(fields.get("BODYSTRUCTURE"))
+    attachments = []
+    for p in parts:
+        name = attachment_name(p) or ""
+        if p["disposition"] != "attachment" or not name.lower().endswith(ALLOWED_EXT):
             continue
+        reason = screen_part(name, p["size"], p["content_id"])
+        if reason:
+            log(f"Skipped attachment {name}: {reason}")
+            continue
+        attachments.append(p)
+    texts = [p for p in parts if p["type"] == "text/plain" and p["disposition"] != "attachment"]
+    return attachments, texts
+
+
+def fetch_sections(mail, plans):
+    """
+    Download the planned parts that fit in one partial fetch; larger ones
+    are streamed to disk by save_attachment(). Messages needing the same
+    sections share one UID FETCH, split so a command carries at most
+    FETCH_MAX_BYTES. Returns {uid: {"BODY[section]": bytes}}.
+    """
+    groups = defaultdict(list)
+    for uid, (attachments, texts) in plans.items():
+        parts = [p for p in attachments + texts if p["size"] <= IMAP_PART_CHUNK]
+        if parts:
+            groups[tuple(p["section"] for p in parts)].append((uid, sum(p["size"] for p in parts)))
+
+    contents = {}
+    for sections, members in groups.items():
+        items = "(" + " ".join(f"BODY.PEEK[{s}]" for s in sections) + ")"
+        batch, size = [], 0
+        for uid, msg_size in members + [(None, 0)]:
+            if batch and (uid is None or size + msg_size > FETCH_MAX_BYTES):
+                typ, data = mail.uid("FETCH", ",".join(str(u) for u in batch), items)
+                if typ == "OK":
+                    contents.update(parse_fetch(data))
+                batch, size = [], 0
+            if uid is not None:
+                batch.append(uid)
+                size += msg_size
+    return contents
+
+
+def decode_subject(raw):
+    try:
+        return str(make_header(decode_header(raw or "")))
+    except Exception:
+        return raw or ""
+
 
-        msg = email.message_from_bytes(resp[1])
-        from_email = msg.get("From", "")
-        received_at = msg.get("Date", "")
-
-        body_text = ""
-        attachment_saved = False
-
-        for part in msg.walk():
-            # -------- EMAIL BODY -------- #
-            if part.get_content_type() == "text/plain":
-                body_text += part.get_payload(decode=True).decode(errors="ignore")
-
-            # -------- ATTACHMENTS -------- #
-            if part.get_content_disposition() == "attachment":
-                name = part.get_filename()
-                if not name:
-                    continue
-
-                name = decode_header(name)[0][0]
-                if isinstance(name, bytes):
-                    name = name.decode()
-
-                if name.lower().endswith(ALLOWED_EXT):
-                    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    uid = uuid.uuid4().hex[:8]
-                    ext = os.path.splitext(name)[1]
-                    fname = f"{ts}_{uid}{ext}"
-
-                    with open(os.path.join(INCOMING, fname), "wb") as f:
-                        f.write(part.get_payload(decode=True))
-
-                    manifest = load_manifest()
-                    manifest[fname] = {
-                        "status": "pending",
-                        "email_metadata": {
-                            "from_email": from_email,
-                            "received_at": received_at
-                        }
-                    }
-                    save_manifest(manifest)
-
-                    log(f"New PO attachment saved: {fname}")
-                    attachment_saved = True
-
-        # -------- EMAIL BODY AS PO -------- #
-        if not attachment_saved and looks_like_po(body_text):
-            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-            uid = uuid.uuid4().hex[:8]
-            fname = f"{ts}_{uid}_email_body.pdf"
-            pdf_path = os.path.join(INCOMING, fname)
-
-            email_body_to_pdf(body_text, pdf_path)
-
-            manifest = load_manifest()
-            manifest[fname] = {
-                "status": "pending",
-                "email_metadata": {
-                    "from_email": from_email,
-                    "received_at": received_at
-                }
-            }
-            save_manifest(manifest)
-
-            log(f"PO detected in email body, saved as: {fname}")
-
-        mail.store(mail_id, "+FLAGS", "\\Seen")
-        mail.logout()
-        return True, INITIAL_POLL
-
-    mail.logout()
-    return False, INITIAL_POLL
+def is_reply(headers):
+    return bool(headers.get("In-Reply-To")) or bool(REPLY_SUBJECT_RE.match(decode_subject(headers.get("Subject"))))
+
+
+def text_body(texts, content):
+    body_text = ""
+    for part in texts:
+        data = decode_part(content.get(f"BODY[{part['section']}]") or b"", part["encoding"])
+        try:
+            body_text += data.decode(part["charset"], errors="ignore")
+        except LookupError:
+            # Charset Python doesn't know ("unknown-8bit")
+            body_text += data.decode("utf-8", errors="ignore")
+    return body_text
+
+
+def save_attachment(mail, uid, part, content):
+    """
+    Decode one attachment part straight into incoming/, hashing it on the
+    way. Parts not prefetched are pulled in IMAP_PART_CHUNK pieces, so
+    memory stays at one chunk whatever the attachment size.
+    Returns (file name, sha256).
+    """
+    ext = os.path.splitext(attachment_name(part))[1]
+    fname = new_file_name(ext)
+    path = os.path.join(INCOMING, fname)
+
+    raw = content.get(f"BODY[{part['section']}]")
+    chunks = [raw] if raw is not None else iter_part(mail, uid, part["section"])
+    decoder = PartDecoder(part["encoding"])
+    digest = hashlib.sha256()
+    try:
+        with open(path, "wb") as f:
+            for chunk in chunks:
+                data = decoder.feed(chunk)
+                digest.update(data)
+                f.write(data)
+            data = decoder.flush()
+            digest.update(data)
+            f.write(data)
+    except BaseException:
+        # Never leave a truncated file behind for the OCR service
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+    return fname, digest.hexdigest()
+
+
+def route_message(mail, uid, uidvalidity, headers, attachments, texts, content):
+    """
+    Dispatch one message: PO attachments and PO-like bodies go to the OCR
+    job queue, replies to the reply listener. Returns "po", "reply" or
+    None (not for us).
+    """
+    from_email = headers.get("From", "")
+    received_at = headers.get("Date", "")
+    meta = {"from_email": from_email, "received_at": received_at}
+
+    saved = False
+    for part in attachments:
+        fname, digest = save_attachment(mail, uid, part, content)
+
+        # Cheap content probe before the file costs an OCR run
+        reason = screen_file(os.path.join(INCOMING, fname), attachment_name(part))
+        if reason:
+            os.replace(os.path.join(INCOMING, fname), os.path.join(REJECTED, fname))
+            log(f"Not a PO, moved to rejected/: {attachment_name(part)} ({reason})")
+            continue
+
+        # The OCR worker keys its extraction cache on this digest
+        job_queue.enqueue(fname, dict(meta, sha256=digest))
+        log(f"New PO attachment saved: {fname}")
+        saved = True
+    if saved:
+        return "po"
+
+    body_text = text_body(texts, content)
+
+    # -------- REPLY TO ONE OF OUR EMAILS -------- #
+    if is_reply(headers):
+        subject = decode_subject(headers.get("Subject"))
+        mail_sync.enqueue_reply(uidvalidity, uid, from_email, subject, body_text)
+        log(f"Reply routed to reply listener: {subject}")
+        return "reply"
+
+    # -------- EMAIL BODY AS PO -------- #
+    if looks_like_po(body_text):
+        fname = new_file_name("_email_body.pdf")
+        email_body_to_pdf(body_text, os.path.join(INCOMING, fname))
+        job_queue.enqueue(fname, meta)
+        log(f"PO detected in email body, saved as: {fname}")
+        return "po"
+    return None
+
+
+def process_batch(mail, uidvalidity, uids, retrying=False):
+    """
+    One UID FETCH for the structure and headers of every message in the
+    batch, then only the parts that matter. A message that fails to route
+    is recorded in mail_failures for a later retry; a connection error
+    stops the batch there.
+    Returns (UIDs handled, UIDs routed somewhere, connection error or None).
+    """
+    typ, data = mail.uid("FETCH", ",".join(str(u) for u in uids),
+                         "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM DATE SUBJECT IN-REPLY-TO)])")
+    if typ != "OK":
+        raise imaplib.IMAP4.error(f"FETCH failed: {data}")
+    meta = parse_fetch(data)
+
+    plans = {uid: plan_message(fields) for uid, fields in meta.items()}
+    contents = fetch_sections(mail, plans)
+
+    done, routed = [], []
+    for uid in uids:
+        if uid not in meta:
+            # Expunged meanwhile
+            if retrying:
+                mail_sync.clear_failure(SYNC_CONSUMER, IMAP_MAILBOX, uidvalidity, uid)
+            done.append(uid)
+            continue
+        raw_headers = next((v for k, v in meta[uid].items() if k.startswith("BODY[HEADER")), b"") or b""
+        headers = BytesHeaderParser().parsebytes(raw_headers)
+        try:
+            if route_message(mail, uid, uidvalidity, headers, *plans[uid], contents.get(uid, {})):
+                routed.append(uid)
+            if retrying:
+                mail_sync.clear_failure(SYNC_CONSUMER, IMAP_MAILBOX, uidvalidity, uid)
+        except (imaplib.IMAP4.abort, OSError) as e:
+            # Not this message's fault: the caller reconnects and resumes here
+            return done, routed, e
+        except Exception as e:
+            log(f"Failed to route message UID {uid}: {e}")
+            mail_sync.record_failure(SYNC_CONSUMER, IMAP_MAILBOX, uidvalidity, uid, e)
+        done.append(uid)
+    return done, routed, None
+
+
+def mark_seen(mail, uids):
+    for i in range(0, len(uids), FETCH_BATCH):
+        mail.uid("STORE", ",".join(str(u) for u in uids[i:i + FETCH_BATCH]), "+FLAGS", "(\\Seen)")
+
+
+def search_uids(mail, criteria):
+    typ, data = mail.uid("SEARCH", None, criteria)
+    return sorted(int(u) for u in data[0].split()) if typ == "OK" and data and data[0] else []
+
+
+def new_uids(mail, uidvalidity):
+    """
+    UIDs past this router's cursor. Without a valid cursor (first run, or
+    the server reset UIDVALIDITY) fall back to UNSEEN once, like the old
+    flag-based polling, so nothing already waiting is skipped.
+    """
+    stored_validity, last_uid = mail_sync.get_cursor(SYNC_CONSUMER, IMAP_MAILBOX)
+    if stored_validity == uidvalidity and uidvalidity is not None:
+        # "n:*" always includes the highest UID, even when it is below n
+        return [u for u in search_uids(mail, f"UID {last_uid + 1}:*") if u > last_uid]
+
+    if stored_validity is not None:
+        log(f"UIDVALIDITY changed ({stored_validity} -> {uidvalidity}); resyncing from UNSEEN")
+    uids = search_uids(mail, "UNSEEN")
+    if not uids:
+        # Nothing waiting: start the cursor at the current end of the mailbox
+        newest = search_uids(mail, "UID *")
+        mail_sync.set_cursor(SYNC_CONSUMER, IMAP_MAILBOX, uidvalidity, newest[-1] if newest else 0)
+    return uids
+
+
+def poll_emails(conn):
+    """
+    Route every message that arrived since the last cycle: one UID SEARCH
+    from the sync cursor, batched UID FETCHes, the cursor advanced after
+    each batch, and a bulk STORE of the Seen flag on routed messages.
+    Earlier failures are retried first. Returns the number of new
+    messages handled.
+    """
+    mail = conn.ensure()
+    retry = mail_sync.retry_uids(SYNC_CONSUMER, IMAP_MAILBOX, conn.uidvalidity)
+    uids = new_uids(mail, conn.uidvalidity)
+    if not uids and not retry:
+        return 0
+
+    handled = 0
+    routed = []
+    try:
+        for i in range(0, len(retry), FETCH_BATCH):
+            _, batch_routed, lost = process_batch(mail, conn.uidvalidity, retry[i:i + FETCH_BATCH], retrying=True)
+            routed.extend(batch_routed)
+            if lost:
+                raise lost
+
+        if uids:
+            log(f"{len(uids)} new message(s)")
+        for i in range(0, len(uids), FETCH_BATCH):
+            done, batch_routed, lost = process_batch(mail, conn.uidvalidity, uids[i:i + FETCH_BATCH])
+            routed.extend(batch_routed)
+            handled += len(done)
+            if done:
+                mail_sync.set_cursor(SYNC_CONSUMER, IMAP_MAILBOX, conn.uidvalidity, done[-1])
+            if lost:
+                raise lost
+    finally:
+        if routed:
+            try:
+                mark_seen(mail, routed)
+            except (imaplib.IMAP4.error, OSError) as e:
+                log(f"Could not mark {len(routed)} message(s) seen: {e}")
+    return handled
 
 
 # ================== MAIN LOOP ================== #
 
 def run():
-    poll_interval = INITIAL_POLL
     idle_logged = False
 
+    job_queue.init_db()
+    job_queue.migrate_manifest()
+    mail_sync.init_db()
+
+    # One persistent connection; between scans it waits in IMAP IDLE, so
+    # new mail is picked up as soon as the server announces it.
+    conn = MailboxConnection(IMAP_MAILBOX, IMAP_SERVER, EMAIL_USER, EMAIL_PASS, name="router")
+
     log("Email ingestion service started")
 
     while True:
         try:
-            found, poll_interval = poll_emails(poll_interval)
-
-            if found:
+            if poll_emails(conn):
                 idle_logged = False
-            else:
-                if not idle_logged:
-                    log("Waiting for new mail...")
-                    idle_logged = True
+                continue        # mail may have arrived meanwhile: scan again before idling
 
-            time.sleep(poll_interval)
+            if not idle_logged:
+                log("Waiting for new mail...")
+                idle_logged = True
+            conn.wait()
 
         except KeyboardInterrupt:
             log("Email ingestion stopped")
+            conn.close()
             break
 
+        except (imaplib.IMAP4.abort, OSError) as e:
+            log(f"Connection error: {e}. Reconnecting...")
+            conn.drop()
+
         except Exception as e:
             log(f"Error: {e}")
-            time.sleep(poll_interval)
+            time.sleep(ERROR_BACKOFF)
 
 
 if __name__ == "__main__":
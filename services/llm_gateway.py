@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import time
+import heapq
+import asyncio
+import itertools
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+
+# Load local environment variables
+load_dotenv()
+
+# Add project root to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# ================= CONFIG ================= #
+
+# Point OLLAMA_URL at this gateway (see .env.example); it forwards to Ollama
+LLM_GATEWAY_HOST = os.getenv("LLM_GATEWAY_HOST", "127.0.0.1")
+LLM_GATEWAY_PORT = int(os.getenv("LLM_GATEWAY_PORT", "11500"))
+OLLAMA_UPSTREAM = os.getenv("OLLAMA_UPSTREAM", "http://localhost:11434")
+
+# Generations run on Ollama at once; match OLLAMA_NUM_PARALLEL
+LLM_GATEWAY_CONCURRENCY = int(os.getenv("LLM_GATEWAY_CONCURRENCY", "1"))
+
+# Lanes by priority. "interactive" always goes first; the others share the
+# remaining slots by weight so batch work is never starved completely.
+LANES = ("interactive", "normal", "batch")
+LANE_WEIGHTS = {"normal": 3, "batch": 1}
+DEFAULT_LANE = "normal"
+DEFAULT_DEADLINE = 300     # seconds, when the client sends none
+
+MAX_HEADER_BYTES = 64 * 1024
+
+# ========================================= #
+
+# A minimal HTTP/1.1 relay on asyncio streams. Each request waits for a
+# slot in its lane's queue, then is forwarded to Ollama with its response
+# (streamed or not) relayed back byte for byte. A client that disconnects
+# while queued leaves the queue; one that disconnects mid-generation
+# (llm_client.generate_json at the end of the JSON) closes the upstream
+# connection, which stops the generation in Ollama.
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class LaneScheduler:
+    """
+    Admission control for Ollama: per-lane queues ordered by deadline.
+    A freed slot goes to the interactive lane if anything is waiting there,
+    otherwise to the other lanes by weighted round robin.
+    """
+
+    def __init__(self, concurrency):
+        self.free = concurrency
+        self.queues = {lane: [] for lane in LANES}
+        self.credits = dict(LANE_WEIGHTS)
+        self.seq = itertools.count()
+        self.stats = {lane: {"served": 0, "expired": 0, "wait_total": 0.0, "wait_max": 0.0} for lane in LANES}
+
+    async def acquire(self, lane, deadline):
+        """Wait for a slot; raises DeadlineExceeded if deadline passes first."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        queued_at = time.monotonic()
+        heapq.heappush(self.queues[lane], (deadline, next(self.seq), fut))
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            if fut.done() and not fut.cancelled():
+                # Granted in the same tick the deadline fired: give it back
+                self.release()
+            fut.cancel()
+            self.stats[lane]["expired"] += 1
+            raise DeadlineExceeded(lane)
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            fut.cancel()
+            raise
+
+        waited = time.monotonic() - queued_at
+        s = self.stats[lane]
+        s["served"] += 1
+        s["wait_total"] += waited
+        s["wait_max"] = max(s["wait_max"], waited)
+        return waited
+
+    def release(self):
+        self.free += 1
+        self._dispatch()
+
+    def _next_lane(self):
+        waiting = [lane for lane in LANES if self.queues[lane]]
+        if not waiting:
+            return None
+        if "interactive" in waiting:
+            return "interactive"
+        if all(self.credits[lane] <= 0 for lane in waiting):
+            self.credits = dict(LANE_WEIGHTS)
+        lane = max(waiting, key=lambda l: self.credits[l])
+        self.credits[lane] -= 1
+        return lane
+
+    def _dispatch(self):
+        while self.free > 0:
+            lane = self._next_lane()
+            if lane is None:
+                return
+            _, _, fut = heapq.heappop(self.queues[lane])
+            if fut.done():
+                continue        # client left or deadline passed while queued
+            self.free -= 1
+            fut.set_result(None)
+
+    def snapshot(self):
+        out = {"free_slots": self.free, "lanes": {}}
+        for lane in LANES:
+            s = self.stats[lane]
+            out["lanes"][lane] = dict(
+                s,
+                wait_total=round(s["wait_total"], 3),
+                wait_max=round(s["wait_max"], 3),
+                queued=sum(1 for _, _, f in self.queues[lane] if not f.done()),
+                wait_avg=round(s["wait_total"] / s["served"], 3) if s["served"] else 0
+            )
+        return out
+
+
+# ================= HTTP ================= #
+
+async def read_request(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    if len(head) > MAX_HEADER_BYTES:
+        raise ValueError("headers too large")
+    lines = head.decode("latin-1").split("\r\n")
+    method, path, _ = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    body = await reader.readexactly(int(headers.get("content-length", "0")))
+    return method, path, headers, body
+
+
+async def send_simple(writer, status, reason, payload):
+    data = json.dumps(payload).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data
+    )
+    await writer.drain()
+
+
+async def relay(method, path, headers, body, client_reader, client_writer):
+    """Forward one request to Ollama and stream the response back."""
+    up = urlsplit(OLLAMA_UPSTREAM)
+    up_reader, up_writer = await asyncio.open_connection(up.hostname, up.port or 80)
+    try:
+        forward = {k: v for k, v in headers.items() if not k.startswith("x-llm-")}
+        forward["host"] = up.netloc
+        forward["connection"] = "close"
+        forward["content-length"] = str(len(body))
+        head = f"{method} {path} HTTP/1.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in forward.items())
+        up_writer.write(head.encode("latin-1") + b"\r\n" + body)
+        await up_writer.drain()
+
+        # The client sends nothing after its request; EOF means it hung up
+        hangup = asyncio.ensure_future(client_reader.read(1))
+        try:
+            while True:
+                chunk = asyncio.ensure_future(up_reader.read(65536))
+                done, _ = await asyncio.wait({chunk, hangup}, return_when=asyncio.FIRST_COMPLETED)
+                if chunk not in done:
+                    chunk.cancel()
+                    return False        # client gone: dropping upstream cancels the generation
+                data = chunk.result()
+                if not data:
+                    return True
+                client_writer.write(data)
+                await client_writer.drain()
+        finally:
+            hangup.cancel()
+    finally:
+        up_writer.close()
+
+
+def make_handler(scheduler):
+
+    async def handle(reader, writer):
+        try:
+            method, path, headers, body = await read_request(reader)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            writer.close()
+            return
+
+        try:
+            if path == "/gateway/stats":
+                await send_simple(writer, 200, "OK", scheduler.snapshot())
+                return
+
+            if method != "POST":
+                # Model listing etc.: cheap, not scheduled
+                await relay(method, path, headers, body, reader, writer)
+                return
+
+            lane = headers.get("x-llm-priority", DEFAULT_LANE)
+            if lane not in LANES:
+                lane = DEFAULT_LANE
+            try:
+                budget = float(headers.get("x-llm-deadline", DEFAULT_DEADLINE))
+            except ValueError:
+                budget = DEFAULT_DEADLINE
+            tag = headers.get("x-llm-tag", "-")
+
+            # The client sends nothing after its request; EOF means it hung up
+            slot = asyncio.ensure_future(scheduler.acquire(lane, time.monotonic() + budget))
+            hangup = asyncio.ensure_future(reader.read(1))
+            await asyncio.wait({slot, hangup}, return_when=asyncio.FIRST_COMPLETED)
+            if not slot.done():
+                slot.cancel()       # acquire() leaves the queue (or returns a just-granted slot)
+                await asyncio.gather(slot, return_exceptions=True)
+                print(f"👋 [{lane}/{tag}] client left while queued")
+                return
+            hangup.cancel()
+            try:
+                waited = slot.result()
+            except DeadlineExceeded:
+                print(f"⏰ [{lane}/{tag}] deadline of {budget:.0f}s passed while queued")
+                # 408: the client's own deadline passed, not worth retrying
+                await send_simple(writer, 408, "Request Timeout", {"error": "deadline exceeded in LLM queue"})
+                return
+
+            t0 = time.monotonic()
+            try:
+                completed = await relay(method, path, headers, body, reader, writer)
+            finally:
+                scheduler.release()
+            print(f"🚦 [{lane}/{tag}] waited {waited:.2f}s, ran {time.monotonic() - t0:.2f}s"
+                  + ("" if completed else " (client closed early)"))
+
+        except (ConnectionError, OSError) as e:
+            print(f"⚠️ Gateway connection error: {e}")
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    return handle
+
+
+async def serve():
+    scheduler = LaneScheduler(LLM_GATEWAY_CONCURRENCY)
+    server = await asyncio.start_server(
+        make_handler(scheduler), LLM_GATEWAY_HOST, LLM_GATEWAY_PORT, limit=MAX_HEADER_BYTES
+    )
+    print(f"🚦 LLM gateway on {LLM_GATEWAY_HOST}:{LLM_GATEWAY_PORT} -> {OLLAMA_UPSTREAM} "
+          f"({LLM_GATEWAY_CONCURRENCY} slot(s), lanes: {', '.join(LANES)})")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve())
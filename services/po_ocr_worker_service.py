@@ -1,38 +1,201 @@
 import time
-import json
 import os
 import sys
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Add project root to sys.path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from core.po_ocr_worker import run_ocr
+from core import job_queue
+from core.job_notify import JobListener, notify
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 INCOMING = os.path.join(BASE_DIR, "incoming")
-MANIFEST = os.path.join(BASE_DIR, "manifest.json")
 
+# Number of OCR worker processes. 1 keeps the original serial loop.
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "1"))
+# Documents processed concurrently inside the (single) service process.
+# Their scanned pages share OCR batches; see core/ocr_batcher.py.
+OCR_THREADS = int(os.getenv("OCR_THREADS", "1"))
+# Load the OCR model once in the parent and fork workers from it, so they
+# share the weights copy-on-write instead of each loading its own copy.
+OCR_PRELOAD = os.getenv("OCR_PRELOAD", "0") == "1"
+POLL_INTERVAL = 2         # seconds, only used if the notify socket is unavailable
+SAFETY_SWEEP = 60         # seconds, max idle wait even without notifications
 
-def load_manifest():
+
+# ================= DISPATCH ================= #
+
+def open_listener():
     try:
-        with open(MANIFEST) as f:
-            return json.load(f)
-    except:
-        return {}
+        return JobListener()
+    except OSError as e:
+        print(f"⚠️ Notify socket unavailable ({e}). Falling back to {POLL_INTERVAL}s polling.")
+        return None
+
+
+def wait_for_work(listener, workers_busy=False):
+    """
+    Sleep until ingestion notifies us, a retry/lease comes due, or the
+    safety sweep elapses, whichever is first.
+    With every worker busy only a finished job (or the sweep) wakes us.
+    """
+    if listener is None:
+        time.sleep(POLL_INTERVAL)
+        return
+
+    timeout = SAFETY_SWEEP
+    due = job_queue.next_visible_at()
+    if due is not None and not workers_busy:
+        timeout = min(timeout, due - time.time())
+    listener.wait(timeout)
+
+
+# ================= WORKER POOL ================= #
+
+def _init_worker():
+    # The worker's PaddleOCR instance is created on its first scanned page
+    # (or inherited from the parent with OCR_PRELOAD) and then stays warm
+    # until it has been idle for OCR_IDLE_RELEASE seconds.
+    import core.po_ocr_worker  # noqa: F401
+    print(f"OCR worker ready (PID {os.getpid()})")
+
 
+def _process(job):
+    from core.po_ocr_worker import run_ocr
+    run_ocr(job)
+    return job["file_name"]
+
+
+def dispatch(listener, slots, submit):
+    """
+    Claim jobs while there are free slots and hand them to submit(job, done),
+    which must call done(file_name) when the job has finished.
+    """
+    in_flight = set()
+
+    def done(file_name):
+        in_flight.discard(file_name)
+        # Wake the dispatcher so it can hand the free slot a new job
+        notify()
 
-def run():
-    print(f"OCR service started. Watching: {INCOMING}")
     while True:
-        manifest = load_manifest()
-        for f, v in manifest.items():
-            if v.get("status") == "pending":
-                file_path = os.path.join(INCOMING, f)
-                if os.path.exists(file_path):
-                    run_ocr(f)
-        time.sleep(2)
+        # Only claim as many jobs as there are free slots, so the
+        # rest stay visible in the queue instead of sitting leased.
+        claimed = False
+        while len(in_flight) < slots:
+            job = job_queue.claim()
+            if not job:
+                break
+            claimed = True
+            in_flight.add(job["file_name"])
+            submit(job, done)
+        if len(in_flight) >= slots:
+            wait_for_work(listener, workers_busy=True)
+        elif not claimed:
+            wait_for_work(listener)
+
+
+def run_serial(listener):
+    from core.po_ocr_worker import run_ocr
+
+    while True:
+        job = job_queue.claim()
+        if job:
+            run_ocr(job)
+        else:
+            wait_for_work(listener)
+
+
+def run_threads(threads, listener):
+    # Several documents in one process: their scanned pages meet in the
+    # shared OCR batcher and are recognized in the same model batches.
+    from core.po_ocr_worker import run_ocr
+
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="ocr-doc") as executor:
+        def submit(job, done):
+            fut = executor.submit(run_ocr, job)
+
+            def _cb(f):
+                if f.exception():
+                    print(f"OCR thread crashed on {job['file_name']}: {f.exception()}")
+                done(job["file_name"])
+            fut.add_done_callback(_cb)
+
+        dispatch(listener, threads, submit)
+
+
+def pool_context():
+    """
+    With OCR_PRELOAD the parent loads the model and workers are forked from
+    it (core/ocr_engine.py restarts its threads in each child). Otherwise
+    "spawn" gives every worker a clean interpreter that loads the model
+    lazily, only if it ever sees a scanned page.
+    """
+    if OCR_PRELOAD and "fork" in multiprocessing.get_all_start_methods():
+        from core import ocr_engine
+        ocr_engine.preload()
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context("spawn")
+
+
+def run_pool(workers, listener):
+    # ProcessPoolExecutor rather than multiprocessing.Pool: when a worker
+    # dies hard (OOM kill, segfault in paddle) Pool never calls back and the
+    # job's slot is lost forever; here its future fails with BrokenProcessPool
+    # and the pool is rebuilt on the next submit.
+    ctx = pool_context()
+
+    def new_pool():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker)
+
+    state = {"pool": new_pool()}
+
+    def submit(job, done):
+        try:
+            fut = state["pool"].submit(_process, job)
+        except BrokenProcessPool:
+            print("⚠️ OCR worker pool broken (a worker died). Restarting it.")
+            state["pool"].shutdown(wait=False)
+            state["pool"] = new_pool()
+            fut = state["pool"].submit(_process, job)
+
+        def _cb(f):
+            if f.exception():
+                # The job stays leased; it becomes visible again after the
+                # visibility timeout and is retried by job_queue.claim.
+                print(f"OCR worker crashed on {job['file_name']}: {f.exception()!r}")
+            done(job["file_name"])
+        fut.add_done_callback(_cb)
+
+    try:
+        dispatch(listener, workers, submit)
+    finally:
+        state["pool"].shutdown(wait=False)
+
+
+def run(workers=OCR_WORKERS, threads=OCR_THREADS):
+    job_queue.init_db()
+    job_queue.migrate_manifest()
+
+    print(f"OCR service started with {workers} worker(s). Watching: {INCOMING}")
+    print(f"Queue: {job_queue.count_by_status()}")
+
+    listener = open_listener()
+    try:
+        if workers > 1:
+            run_pool(workers, listener)
+        elif threads > 1:
+            run_threads(threads, listener)
+        else:
+            run_serial(listener)
+    finally:
+        if listener:
+            listener.close()
 
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    run()
@@ -7,6 +7,10 @@ mkdir -p $LOG_DIR
 
 echo "🚀 Starting PO Pipeline Project..."
 
+# 0. Start LLM Gateway (priority queue in front of Ollama)
+nohup $VENV_PYTHON services/llm_gateway.py > $LOG_DIR/llm_gateway.log 2>&1 &
+echo "✅ LLM Gateway started (PID $!)"
+
 # 1. Start Flask App
 nohup $VENV_PYTHON flask_app/app.py > $LOG_DIR/flask.log 2>&1 &
 echo "✅ Flask App started (PID $!)"
@@ -8,5 +8,6 @@ pkill -f "services/email_ingestion_imap.py"
 pkill -f "services/po_ocr_worker_service.py"
 pkill -f "services/reply_listener.py"
 pkill -f "services/scheduler.py"
+pkill -f "services/llm_gateway.py"
 
 echo "✅ All services stopped."